@@ -0,0 +1,85 @@
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+# file layout: MAGIC, <u4 format version, <u8 header length, UTF-8 JSON header, then every array
+# as raw little-endian bytes at an ALIGNMENT-aligned offset recorded in the header
+MAGIC = b"ARRBNDL\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sIQ")
+
+
+def _aligned(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def strings_to_arrays(strings: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    encoded = [s.encode("utf-8", "surrogatepass") for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def arrays_to_strings(blob: np.ndarray, offsets: np.ndarray) -> List[str]:
+    data = blob.tobytes()
+    bounds = offsets.tolist()
+    return [data[start:end].decode("utf-8", "surrogatepass") for start, end in zip(bounds, bounds[1:])]
+
+
+def write_bundle(path: Path, arrays: Dict[str, np.ndarray], meta: Dict[str, object]):
+    entries = {}
+    offset = 0
+    arrays = {name: np.ascontiguousarray(array, dtype=np.asarray(array).dtype.newbyteorder("<"))
+              for name, array in arrays.items()}
+    for name, array in arrays.items():
+        offset = _aligned(offset)
+        entries[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += array.nbytes
+
+    # array offsets are relative to the data section, which starts after the header
+    header = json.dumps({"meta": meta, "arrays": entries}).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+
+    partial = Path("{}.{}.tmp".format(path, os.getpid()))
+    with open(partial, "wb") as dst:
+        dst.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        dst.write(header)
+        for name, array in arrays.items():
+            dst.seek(data_start + entries[name]["offset"])
+            dst.write(array.tobytes())
+        dst.truncate(data_start + offset)
+    os.replace(partial, path)
+
+
+def read_bundle(path: Path, writable: bool = False) -> Tuple[Dict[str, object], Dict[str, np.ndarray]]:
+    # arrays are read-only views of one shared mapping; nothing is copied or deserialized per entry.
+    # writable maps the file copy-on-write instead, for consumers such as torch.from_numpy that want
+    # writable memory: pages are still shared until something writes to them
+    with open(path, "rb") as src:
+        buffer = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_COPY if writable else mmap.ACCESS_READ)
+
+    magic, version, header_length = _PREAMBLE.unpack_from(buffer, 0)
+    if magic != MAGIC:
+        raise ValueError("{} is not an array bundle".format(path))
+    if version != FORMAT_VERSION:
+        raise ValueError("{} has bundle format version {}, expected {}".format(path, version, FORMAT_VERSION))
+    header = json.loads(bytes(buffer[_PREAMBLE.size:_PREAMBLE.size + header_length]).decode("utf-8"))
+    data_start = _aligned(_PREAMBLE.size + header_length)
+
+    arrays = {}
+    for name, entry in header["arrays"].items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        if count == 0:
+            arrays[name] = np.zeros(entry["shape"], dtype=dtype)
+            continue
+        array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_start + entry["offset"])
+        arrays[name] = array.reshape(entry["shape"])
+    return header["meta"], arrays
@@ -0,0 +1,205 @@
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import torch
+
+import myprogram
+import predict
+from server import percentile
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1 << 20)
+
+
+def synthetic_prefixes(text: str, length: int, count: int, seed: int = 0) -> List[str]:
+    # random slices of the language's dummy prompt, repeated when it is shorter than the prefix
+    text = text * (length // len(text) + 2)
+    rng = random.Random(seed)
+    starts = [rng.randrange(len(text) - length) for _ in range(count)]
+    return [text[start:start + length] for start in starts]
+
+
+def real_prefixes(path: str, length: int, count: int, seed: int = 0) -> List[str]:
+    # the last `length` symbols before a random cut in each line long enough to have one
+    with open(path) as f:
+        lines = [line.rstrip("\n").lower() for line in f if len(line) > length + 1]
+    rng = random.Random(seed)
+    prefixes = []
+    for line in rng.choices(lines, k=count) if lines else []:
+        end = rng.randrange(length, len(line) + 1)
+        prefixes.append(line[end - length:end])
+    return prefixes
+
+
+def case_prefixes(source: str, origin: str, length: int, count: int) -> List[str]:
+    if source == "synthetic":
+        return synthetic_prefixes(origin, length, count)
+    return real_prefixes(origin, length, count)
+
+
+def time_batches(predict_fn: Callable[[List[str]], List[str]], prefixes: List[str],
+                 batch_size: int) -> Dict[str, float]:
+    # every line in a batch waits for the whole batch, so each line's latency is its batch's wall time;
+    # the percentiles are over lines, so a short last batch counts once per line it holds
+    predict_fn(prefixes[:batch_size])
+    latencies = []
+    start = time.perf_counter()
+    for i in range(0, len(prefixes), batch_size):
+        batch = prefixes[i:i + batch_size]
+        batch_start = time.perf_counter()
+        predict_fn(batch)
+        latencies.extend([time.perf_counter() - batch_start] * len(batch))
+    seconds = time.perf_counter() - start
+    return {"lines": len(prefixes), "lines_per_s": len(prefixes) / seconds if seconds > 0 else 0.0,
+            "line_p50_ms": 1000 * percentile(latencies, 0.5), "line_p99_ms": 1000 * percentile(latencies, 0.99),
+            "peak_rss_mb": peak_rss_mb()}
+
+
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, sys.argv[1])
+import myprogram
+imported = time.perf_counter()
+my_model = myprogram.MyModel(cache_size=0, **json.loads(sys.argv[2]))
+my_model.run_pred([sys.argv[4]], langs=[sys.argv[3]])
+print(json.dumps({"import": imported - start, "first_prediction": time.perf_counter() - imported}))
+"""
+
+
+def cold_start(lang: str, line: str, model_kwargs: Dict[str, object]) -> Dict[str, float]:
+    # a fresh interpreter, timed from the parent: what a test run or a restarted server waits before its first
+    # answer. "interpreter" is the python start-up before myprogram's import, and its exit
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", COLD_START, os.path.dirname(os.path.abspath(__file__)),
+                                json.dumps(model_kwargs), lang, line], capture_output=True, text=True, check=True)
+    total = time.perf_counter() - start
+    child = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {"process": total, "interpreter": total - child["import"] - child["first_prediction"],
+            "import": child["import"], "first_prediction": child["first_prediction"]}
+
+
+def run(langs: List[str], lengths: List[int], batch_sizes: List[int], count: int,
+        data: Dict[str, str], ngram_path: Optional[str] = None, **model_kwargs) -> Dict[str, object]:
+    startup = cold_start(langs[0], myprogram.CONFIGS[langs[0]].dummy_prompt, model_kwargs) if langs else {}
+    # no prediction cache: the warm-up batch would otherwise answer the timed one
+    my_model = myprogram.MyModel(cache_size=0, **model_kwargs)
+
+    cases: List[Tuple[str, str, str]] = [(lang, "synthetic", myprogram.CONFIGS[lang].dummy_prompt) for lang in langs]
+    cases += [(lang, "real", path) for lang, path in data.items()]
+
+    results = []
+    for lang, source, origin in cases:
+        if lang not in my_model.my_models:
+            load_start = time.perf_counter()
+            my_model.my_models[lang]
+            startup["load_" + lang] = time.perf_counter() - load_start
+
+        for length in lengths:
+            prefixes = case_prefixes(source, origin, length, count)
+            for batch_size in batch_sizes if prefixes else ():
+                # pin the language so a misrouted synthetic prefix cannot change what is measured
+                timing = time_batches(lambda lines: my_model.run_pred(lines, batch_size, langs=[lang] * len(lines)),
+                                      prefixes, batch_size)
+                results.append(dict(predictor="transformer", lang=lang, source=source, length=length,
+                                    batch_size=batch_size, **timing))
+
+    if ngram_path is not None:
+        load_start = time.perf_counter()
+        table, unknown_chars, _ = predict.load_model(ngram_path)
+        startup["ngram"] = time.perf_counter() - load_start
+        for lang, source, origin in cases:
+            for length in lengths:
+                prefixes = case_prefixes(source, origin, length, count)
+                for batch_size in batch_sizes if prefixes else ():
+                    timing = time_batches(lambda lines: predict.pred_lines(table, lines, unknown_chars),
+                                          prefixes, batch_size)
+                    results.append(dict(predictor="ngram", lang=lang, source=source, length=length,
+                                        batch_size=batch_size, **timing))
+
+    return {"meta": {"python": platform.python_version(), "torch": torch.__version__,
+                     "threads": torch.get_num_threads(), "machine": platform.machine(),
+                     "model": {key: value for key, value in model_kwargs.items() if key != "warm_up"}},
+            "startup_s": startup, "peak_rss_mb": peak_rss_mb(), "results": results}
+
+
+def case_key(result: Dict[str, object]) -> Tuple:
+    return (result["predictor"], result["lang"], result["source"], result["length"], result["batch_size"])
+
+
+def compare(baseline: Dict[str, object], candidate: Dict[str, object], tolerance: float) -> List[str]:
+    # a case regresses when throughput drops or p99 latency grows by more than `tolerance` (a fraction)
+    before = {case_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in candidate["results"]:
+        old = before.get(case_key(result))
+        if old is None:
+            continue
+        name = "{} {} {} length={} batch={}".format(*case_key(result))
+        if result["lines_per_s"] < old["lines_per_s"] * (1 - tolerance):
+            regressions.append("{}: {:.1f} -> {:.1f} lines/s".format(name, old["lines_per_s"], result["lines_per_s"]))
+        # runs from before the percentiles were per line only have per-batch ones, which are not comparable
+        if "line_p99_ms" in old and result["line_p99_ms"] > old["line_p99_ms"] * (1 + tolerance):
+            regressions.append("{}: p99 {:.2f} -> {:.2f} ms".format(name, old["line_p99_ms"], result["line_p99_ms"]))
+    if candidate["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        regressions.append("peak RSS {:.0f} -> {:.0f} MB".format(baseline["peak_rss_mb"], candidate["peak_rss_mb"]))
+    return regressions
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    run_parser = subparsers.add_parser("run", help="time the predictors and write the results as JSON")
+    run_parser.add_argument("output")
+    run_parser.add_argument("--langs", nargs="*", choices=sorted(myprogram.CONFIGS), default=sorted(myprogram.CONFIGS))
+    run_parser.add_argument("--lengths", type=int, nargs="*", default=[16, 64, 256],
+                            help="prefix lengths; the models read the last 64 symbols")
+    run_parser.add_argument("--batch_sizes", type=int, nargs="*", default=[1, 32, 256])
+    run_parser.add_argument("--count", type=int, default=512, help="prefixes per case")
+    run_parser.add_argument("--data", nargs="*", default=[], metavar="LANG=PATH",
+                            help="real text to cut prefixes from, per language")
+    run_parser.add_argument("--ngram", default=None, help="also time this n-gram model")
+    run_parser.add_argument("--quantize", action="store_true")
+    run_parser.add_argument("--fuse", action="store_true")
+    run_parser.add_argument("--multilingual", default=None)
+    run_parser.add_argument("--bundle", default=None, help="load the models from this weights bundle")
+    compare_parser = subparsers.add_parser("compare", help="report regressions of a run against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.mode == "run":
+        data = dict(item.split("=", 1) for item in args.data)
+        report = run(args.langs, args.lengths, args.batch_sizes, args.count, data, ngram_path=args.ngram,
+                     quantize=args.quantize, fuse=args.fuse, multilingual=args.multilingual,
+                     bundle=args.bundle)
+        for result in report["results"]:
+            print("{predictor} {lang} {source} length={length} batch={batch_size}: {lines_per_s:.1f} lines/s, "
+                  "p50 {line_p50_ms:.2f} ms, p99 {line_p99_ms:.2f} ms per line".format(**result))
+        print("startup: {}".format({key: round(value, 3) for key, value in report["startup_s"].items()}))
+        print("peak RSS: {:.0f} MB".format(report["peak_rss_mb"]))
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.candidate) as f:
+            candidate = json.load(f)
+        regressions = compare(baseline, candidate, args.tolerance)
+        for regression in regressions:
+            print(regression)
+        print("{} regressions".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,123 @@
+import json
+import random
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import predict
+
+
+class NGramGate:
+    # answers from a compiled n-gram top-k table when it is confident enough, so only the rest of the
+    # lines reach the transformer. "mass" is the interpolated probability of the top 3 symbols, "margin"
+    # is how far the 3rd best is ahead of the 4th (which needs a table compiled with k > 3)
+    def __init__(self, table: predict.TopKTable, unknown_chars, threshold: float, gate: str = "mass"):
+        if gate == "margin" and table.k <= 3:
+            raise ValueError("margin gating needs an n-gram table compiled with k > 3, got k = {}".format(table.k))
+        self.table = table
+        self.unknown_chars = unknown_chars
+        # '<stop>' and '<unk>' can rank in the table, but a line cannot be continued with them
+        self.special_ids = np.array([table.token_ids[token] for token in predict.SPECIAL_TOKENS
+                                     if token in table.token_ids], dtype=np.int64)
+        self.threshold = threshold
+        self.gate = gate
+
+    @classmethod
+    def load(cls, path: str, threshold: float, gate: str = "mass") -> "NGramGate":
+        table, unknown_chars, _ = predict.load_model(path)
+        return cls(table, unknown_chars, threshold, gate)
+
+    def scores(self, lines: List[str], k: int = 3) -> Tuple[List[str], np.ndarray]:
+        contexts = predict.line_contexts(lines, self.unknown_chars)
+        ids, probs = self.table.lookup_ids([tok_1 for tok_1, _ in contexts], [tok_2 for _, tok_2 in contexts])
+        # usable symbols first, in table order; the rest (and empty slots) count as probability 0
+        usable = ~np.isin(ids, self.special_ids) & (probs > 0)
+        order = np.argsort(~usable, axis=1, kind="stable")
+        ids = np.take_along_axis(ids, order, axis=1)
+        probs = np.where(np.take_along_axis(usable, order, axis=1), np.take_along_axis(probs, order, axis=1), 0)
+        results = ["".join(self.table.vocab[i] for i in row[:min(k, count)])
+                   for row, count in zip(ids.tolist(), usable.sum(axis=1).tolist())]
+        if self.gate == "margin":
+            confidence = probs[:, k - 1] - probs[:, k]
+        else:
+            confidence = probs[:, :k].sum(axis=1)
+        return results, confidence
+
+    def predict(self, lines: List[str], k: int = 3) -> Tuple[List[str], np.ndarray]:
+        # (n-gram predictions, which of them are confident enough to be the answer)
+        results, confidence = self.scores(lines, k)
+        return results, confidence >= self.threshold
+
+
+def parse_gates(specs: List[str], threshold: float, gate: str = "mass") -> Dict[str, NGramGate]:
+    return {lang: NGramGate.load(path, threshold, gate) for lang, path in (spec.split("=", 1) for spec in specs)}
+
+
+def heldout_prefixes(path: str, count: int, seed: int = 0) -> Tuple[List[str], List[str]]:
+    # (prefix, next symbol) pairs cut at random positions of random lines
+    with open(path) as f:
+        lines = [line.rstrip("\n").lower() for line in f if len(line.rstrip("\n")) > 1]
+    rng = random.Random(seed)
+    prefixes, targets = [], []
+    for line in rng.choices(lines, k=count) if lines else []:
+        end = rng.randrange(1, len(line))
+        prefixes.append(line[:end])
+        targets.append(line[end])
+    return prefixes, targets
+
+
+def calibrate(my_model, lang: str, gate: NGramGate, prefixes: List[str], targets: List[str],
+              thresholds: List[float], batch_size: int = 256) -> List[Dict[str, float]]:
+    # runs both predictors on every prefix once, then replays each threshold from the saved answers;
+    # latency per line is the n-gram cost plus the transformer cost of the lines it hands over
+    my_model.my_models[lang]
+    start = time.perf_counter()
+    ngram_preds, confidence = gate.scores(prefixes)
+    ngram_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    neural_preds = my_model.run_pred(prefixes, batch_size, langs=[lang] * len(prefixes))
+    neural_seconds = time.perf_counter() - start
+
+    ngram_hits = np.array([target in pred for pred, target in zip(ngram_preds, targets)])
+    neural_hits = np.array([target in pred for pred, target in zip(neural_preds, targets)])
+    lines = max(len(prefixes), 1)
+    rows = []
+    for threshold in thresholds:
+        confident = confidence >= threshold
+        rows.append({"threshold": threshold, "ngram_share": float(confident.mean()) if len(prefixes) else 0.0,
+                     "accuracy": float(np.where(confident, ngram_hits, neural_hits).mean()) if len(prefixes) else 0.0,
+                     "ms_per_line": 1000 * (ngram_seconds + neural_seconds * (1 - confident.mean())) / lines})
+    return rows
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    import myprogram
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("data", nargs="+", metavar="LANG=PATH", help="held-out text per language")
+    parser.add_argument("--ngram", nargs="+", required=True, metavar="LANG=PATH", help="n-gram model per language")
+    parser.add_argument("--gate", choices=("mass", "margin"), default="mass")
+    parser.add_argument("--thresholds", type=float, nargs="*", default=[i / 20 for i in range(21)])
+    parser.add_argument("--count", type=int, default=4096, help="held-out prefixes per language")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--bundle", default=None)
+    parser.add_argument("--output", default=None, help="also write the sweep as JSON")
+    args = parser.parse_args()
+
+    gates = parse_gates(args.ngram, 0.0, args.gate)
+    # the prediction cache would let later prefixes ride on earlier ones and skew the timing
+    my_model = myprogram.MyModel(cache_size=0, bundle=args.bundle)
+    sweeps = {}
+    for lang, path in (spec.split("=", 1) for spec in args.data):
+        prefixes, targets = heldout_prefixes(path, args.count)
+        sweeps[lang] = calibrate(my_model, lang, gates[lang], prefixes, targets, args.thresholds, args.batch_size)
+        print("{}: {} prefixes".format(lang, len(prefixes)))
+        print("  threshold  n-gram share  accuracy  ms/line")
+        for row in sweeps[lang]:
+            print("  {threshold:9.3f}  {ngram_share:12.3f}  {accuracy:8.4f}  {ms_per_line:7.3f}".format(**row))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(sweeps, f, indent=2)
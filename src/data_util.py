@@ -1,20 +1,107 @@
+import bz2
+import gzip
+import hashlib
+import itertools
 import json
+import lzma
+import multiprocessing
+import multiprocessing.pool
+import time
+from collections import deque
 from pathlib import Path
 import string
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Iterable, Iterator, Optional, List, Sequence, Union
 
+import numpy as np
 
-def convert_jsonlist(src_path: Path, dst_path: Path):
+
+COMPRESSED_OPENERS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+
+
+def open_text(path: Path):
+    opener = COMPRESSED_OPENERS.get(Path(path).suffix, open)
+    return opener(path, "rt", encoding="utf-8")
+
+
+_convert_indexer: Optional["SymbolIndexer"] = None
+_convert_separator: str = "\n"
+
+
+def _init_convert(indexer: Optional["SymbolIndexer"], separator: str):
+    global _convert_indexer, _convert_separator
+    _convert_indexer = indexer
+    _convert_separator = separator
+
+
+def _convert_chunk(lines: List[str]):
     COMMENTS: str = "comments"
     BODY: str = "body"
 
-    with open(src_path, 'r') as src, open(dst_path, 'w') as dst:
-        for line in src:
-            post = json.loads(line)
-            if COMMENTS in post:
-                for comment in post[COMMENTS]:
-                    if BODY in comment:
-                        dst.writelines([comment[BODY].lower()])
+    bodies = []
+    for line in lines:
+        if not line.strip():
+            continue
+        post = json.loads(line)
+        if COMMENTS in post:
+            for comment in post[COMMENTS]:
+                if BODY in comment:
+                    body = comment[BODY].lower()
+                    if _convert_indexer is not None:
+                        body = _convert_indexer.filter(body)
+                    bodies.append(body + _convert_separator)
+    return len(lines), sum(len(line) for line in lines), "".join(bodies)
+
+
+def bounded_imap(pool: multiprocessing.pool.Pool, func: Callable, iterable: Iterable, max_pending: int,
+                 ordered: bool = True) -> Iterator:
+    # Pool.imap drains its input eagerly; this keeps at most max_pending tasks in flight so
+    # streaming inputs are never queued in memory as a whole
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        while len(pending) >= max_pending:
+            if ordered or pending[0].ready():
+                yield pending.popleft().get()
+                continue
+            ready = [result for result in pending if result.ready()]
+            if not ready:
+                pending[0].wait(0.01)
+            for result in ready:
+                pending.remove(result)
+                yield result.get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def convert_jsonlist(src_path: Path, dst_path: Path, workers: Optional[int] = None, chunk_lines: int = 4096,
+                     ordered: bool = True, indexer: Optional["SymbolIndexer"] = None, separator: str = "\n",
+                     report_every: float = 10.0) -> Dict[str, float]:
+    workers = workers or multiprocessing.cpu_count()
+    stats = {"lines": 0, "chars_in": 0, "chars_out": 0, "seconds": 0.0}
+    start = last_report = time.perf_counter()
+
+    def write(result):
+        nonlocal last_report
+        lines, chars_in, text = result
+        dst.write(text)
+        stats["lines"] += lines
+        stats["chars_in"] += chars_in
+        stats["chars_out"] += len(text)
+        now = time.perf_counter()
+        if now - last_report >= report_every:
+            last_report = now
+            print("{:,} lines, {:.1f} MB/s".format(stats["lines"], stats["chars_in"] / (now - start) / 1e6))
+
+    with open_text(src_path) as src, open(dst_path, 'w') as dst, \
+            multiprocessing.Pool(workers, initializer=_init_convert, initargs=(indexer, separator)) as pool:
+        chunks = iter(lambda: list(itertools.islice(src, chunk_lines)), [])
+        for result in bounded_imap(pool, _convert_chunk, chunks, 2 * workers, ordered=ordered):
+            write(result)
+
+    stats["seconds"] = time.perf_counter() - start
+    print("Converted {:,} lines in {:.1f}s ({:.1f} MB/s)".format(
+        stats["lines"], stats["seconds"], stats["chars_in"] / max(stats["seconds"], 1e-9) / 1e6))
+    return stats
 
 
 class SymbolIndexer:
@@ -24,6 +111,10 @@ class SymbolIndexer:
     _unknown_idx: int
     _size: int
 
+    _symbols: List[str]
+    _codepoint_to_index: np.ndarray
+    _index_to_symbol: np.ndarray
+
     def _add_symbol(self, symbol: str):
         self._known_symbol_to_index[symbol] = self._size
         self._index_to_known_symbol[self._size] = symbol
@@ -42,9 +133,69 @@ class SymbolIndexer:
         for elem in data:
             self._add_symbol(elem)
 
+        self._symbols = list(data)
+        self._build_tables()
+
+    def _build_tables(self):
+        single = {symbol: index for symbol, index in self._known_symbol_to_index.items() if len(symbol) == 1}
+        table_size = max((ord(symbol) for symbol in single), default=0) + 1
+        self._codepoint_to_index = np.full(table_size, self._unknown_idx, dtype=self.dtype)
+        for symbol, index in single.items():
+            self._codepoint_to_index[ord(symbol)] = index
+        self._index_to_symbol = np.array([self._index_to_known_symbol.get(i, "") for i in range(self._size)],
+                                         dtype=object)
+
     def size(self) -> int:
         return self._size
 
+    @property
+    def unknown_index(self) -> int:
+        return self._unknown_idx
+
+    @property
+    def symbols(self) -> List[str]:
+        return list(self._symbols)
+
+    def fingerprint(self) -> str:
+        digest = hashlib.sha1("\0".join(self._symbols).encode("utf-8", "surrogatepass"))
+        digest.update(self.dtype.str.encode())
+        return digest.hexdigest()[:16]
+
+    @property
+    def dtype(self) -> np.dtype:
+        # uint8 covers the small alphabets; hindi() needs more than 256 indices
+        if self._size <= 1 << 8:
+            return np.dtype(np.uint8)
+        if self._size <= 1 << 15:
+            return np.dtype(np.int16)
+        return np.dtype(np.int32)
+
+    def encode(self, text: Union[str, Sequence[str]]) -> np.ndarray:
+        if not isinstance(text, str):
+            lengths = {len(line) for line in text}
+            if len(lengths) > 1:
+                raise ValueError("encode expects strings of equal length, got lengths {}".format(sorted(lengths)))
+            return self.encode("".join(text)).reshape(len(text), lengths.pop() if lengths else 0)
+
+        codepoints = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        indices = self._codepoint_to_index.take(codepoints, mode="clip")
+        indices[codepoints >= len(self._codepoint_to_index)] = self._unknown_idx
+        return indices
+
+    def filter(self, text: str) -> str:
+        codepoints = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        known = self._codepoint_to_index.take(codepoints, mode="clip") != self._unknown_idx
+        known &= codepoints < len(self._codepoint_to_index)
+        return codepoints[known].tobytes().decode("utf-32-le", "surrogatepass")
+
+    def decode(self, indices: Union[np.ndarray, Sequence[int]], unknown: str = "") -> Union[str, List[str]]:
+        indices = np.asarray(indices)
+        if indices.ndim > 1:
+            return [self.decode(row, unknown) for row in indices]
+        symbols = self._index_to_symbol.take(indices.astype(np.int64))
+        symbols[indices == self._unknown_idx] = unknown
+        return "".join(symbols)
+
     def to_index(self, symbol: str) -> int:
         return self._known_symbol_to_index[symbol] if symbol in self._known_symbol_to_index else self._unknown_idx
 
@@ -82,3 +233,25 @@ class SymbolIndexer:
     @classmethod
     def hindi(cls):
         return cls([s for s in ("आइईउऊऋएऐओऔअंअःकककाकिकीकुकूकृकेकैकोकौकंकःखखखाखिखीखुखूखृखेखैखोखौखंखःगगगागिगीगुगूगृगेगैगोगौगंगःघघघाघिघीघुघूघृघेघैघोघौघंघःङङङाङिङीङुङूङृङेङैङोङौङंङःचचचाचिचीचुचूचृचेचैचोचौचंचःछछछाछिछीछुछूछृछेछैछोछौछंछःजजजाजिजीजुजूजृजेजैजोजौजंजःझझझाझिझीझुझूझृझेझैझोझौझंझःञञञाञिञीञुञूञृञेञैञोञौञंञःटटटाटिटीटुटूटृटेटैटोटौटंटःठठठाठिठीठुठूठृठेठैठोठौठंठःडडडाडिडीडुडूडृडेडैडोडौडंडःढढढाढिढीढुढूढृढेढैढोढौढंढःणणणाणिणीणुणूणृणेणैणोणौणंणःतततातितीतुतूतृतेतैतोतौतंतःथथथाथिथीथुथूथृथेथैथोथौथंथःदददादिदीदुदूदृदेदैदोदौदंदःधधधाधिधीधुधूधृधेधैधोधौधंधःनननानिनीनुनूनृनेनैनोनौनंनःपपपापिपीपुपूपृपेपैपोपौपंपःफफफाफिफीफुफूफृफेफैफोफौफंफःबबबाबिबीबुबूबृबेबैबोबौबंबःभभभाभिभीभुभूभृभेभैभोभौभंभःमममामिमीमुमूमृमेमैमोमौमंमःयययायियीयुयूयृयेयैयोयौयंयःरररारिरीरुरूरृरेरैरोरौरंरःलललालिलीलुलूलृलेलैलोलौलंलःवववाविवीवुवूवृवेवैवोवौवंवःशशशाशिशीशुशूशृशेशैशोशौशंशःषषषाषिषीषुषूषृषेषैषोषौषंषःसससासिसीसुसूसृसेसैसोसौसंसःहहहाहिहीहुहूहृहेहैहोहौहंहःळळळाळिळीळुळूळृळेळैळोळौळंळःक्षक्षक्षाक्षिक्षीक्षुक्षूक्षृक्षेक्षैक्षोक्षौक्षंक्षःज्ञज्ञज्ञाज्ञिज्ञीज्ञुज्ञूज्ञृज्ञेज्ञैज्ञोज्ञौज्" + "०१२३४५६७८९" + "|,!?")])
+
+
+LANGUAGE_INDEXERS = {'en': SymbolIndexer.english, 'es': SymbolIndexer.spanish, 'ru': SymbolIndexer.russian,
+                     'ja': SymbolIndexer.japanese, 'no': SymbolIndexer.norwegian, 'zh': SymbolIndexer.chinese,
+                     'hi': SymbolIndexer.hindi, 'fr': SymbolIndexer.french}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("src", type=Path, help="JSONL dump, optionally .gz/.bz2/.xz compressed")
+    parser.add_argument("dst", type=Path, help="where to write the comment bodies")
+    parser.add_argument("--workers", type=int, default=None, help="parsing processes (default: all cores)")
+    parser.add_argument("--chunk_lines", type=int, default=4096, help="JSON lines per worker task")
+    parser.add_argument("--unordered", action="store_true", help="write chunks as soon as they finish")
+    parser.add_argument("--indexer", default=None, help="drop symbols unknown to SymbolIndexer.<name>()")
+    args = parser.parse_args()
+
+    indexer = getattr(SymbolIndexer, args.indexer)() if args.indexer else None
+    convert_jsonlist(args.src, args.dst, workers=args.workers, chunk_lines=args.chunk_lines,
+                     ordered=not args.unordered, indexer=indexer)
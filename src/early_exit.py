@@ -0,0 +1,171 @@
+import os
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import model
+import text_dataset
+
+
+def exit_heads_path(chkpt_path: str, lang: str) -> str:
+    # next to the weights, per language, so a checkpoint and a bundle in the same directory share heads
+    return os.path.join(os.path.dirname(chkpt_path), "{}.exits.pt".format(lang))
+
+
+def make_exit_heads(function: model.BasicModel, copy_output: bool = True) -> nn.ModuleList:
+    # one head per layer except the last, which keeps the model's own head; for training they start
+    # as copies of it
+    heads = nn.ModuleList()
+    for _ in function.attention_layers()[:-1]:
+        head = nn.Linear(function.out.in_features, function.out.out_features)
+        if copy_output:
+            head.load_state_dict(function.out.state_dict())
+        heads.append(head)
+    return heads
+
+
+def load_exit_heads(function: model.BasicModel, path: str) -> nn.ModuleList:
+    # the model may be quantized; the heads are plain fp32 layers either way
+    heads = make_exit_heads(function, copy_output=False)
+    heads.load_state_dict(torch.load(path, map_location="cpu"))
+    return heads.eval()
+
+
+class EarlyExitModel(nn.Module):
+    # runs the attention stack on the rows of a batch that are still undecided: after each layer the
+    # last position is scored by that layer's exit head (or the shared output head when there are no
+    # exit heads), and rows whose top-k probability mass reaches `threshold` stop there
+    def __init__(self, function: model.BasicModel, threshold: float, heads: Optional[nn.ModuleList] = None,
+                 k: int = 3):
+        super().__init__()
+        self.function = function
+        self.heads = heads
+        self.threshold = threshold
+        self.k = k
+        self.exits = Counter()
+
+    def head(self, i: int) -> nn.Module:
+        return self.heads[i] if self.heads is not None else self.function.out
+
+    def confidence(self, logits: torch.Tensor) -> torch.Tensor:
+        # the unknown symbol is never predicted, so its probability does not count toward confidence
+        logits = logits.clone()
+        logits[:, self.function.embed.indexer.unknown_index] = float("-inf")
+        return F.softmax(logits, dim=-1).topk(self.k, dim=-1).values.sum(dim=-1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # returns the logits of the last position only, [N, D]
+        function = self.function
+        layers = function.attention_layers()
+        h = function.pe(function.embed(x))
+        rows = torch.arange(h.size(0))
+        logits = torch.empty(h.size(0), function.out.out_features)
+        for i, layer in enumerate(layers):
+            h = layer(h)
+            if i == len(layers) - 1:
+                logits[rows] = function.out(h[:, -1])
+                self.exits[i] += len(rows)
+                break
+
+            layer_logits = self.head(i)(h[:, -1])
+            done = self.confidence(layer_logits) >= self.threshold
+            logits[rows[done]] = layer_logits[done]
+            self.exits[i] += int(done.sum())
+            rows, h = rows[~done], h[~done]
+            if len(rows) == 0:
+                break
+        return logits
+
+
+def train_exit_heads(function: model.BasicModel, dataset: text_dataset.TextDataset, steps: int = 2000,
+                     batch_size: int = 64, lr: float = 1e-3) -> nn.ModuleList:
+    # the main stack stays frozen; each head learns to predict the next symbol from its layer's features.
+    # dataset windows are one symbol longer than the model's and are read from the mapped corpus per batch
+    function = function.eval()
+    for parameter in function.parameters():
+        parameter.requires_grad_(False)
+    heads = make_exit_heads(function)
+    optimizer = torch.optim.Adam(heads.parameters(), lr=lr)
+    for step in range(steps):
+        batch = torch.stack([dataset[i] for i in torch.randint(len(dataset), (batch_size,)).tolist()]).long()
+        x, y = batch[:, :-1], batch[:, 1:]
+        with torch.no_grad():
+            h = function.pe(function.embed(x))
+            features = []
+            for layer in function.attention_layers()[:-1]:
+                h = layer(h)
+                features.append(h)
+        loss = sum(F.cross_entropy(head(feature).transpose(1, 2), y) for head, feature in zip(heads, features))
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        if step % 200 == 0:
+            print("step {}: loss {:.4f}".format(step, loss.item() / len(heads)))
+    return heads.eval()
+
+
+def sweep(function: model.BasicModel, heads: Optional[nn.ModuleList], windows: torch.Tensor, targets: torch.Tensor,
+          thresholds: List[float], k: int = 3, batch_size: int = 256) -> List[Dict[str, object]]:
+    rows = []
+    for threshold in thresholds:
+        early = EarlyExitModel(function, threshold, heads, k).eval()
+        hits = 0
+        with torch.inference_mode():
+            start = time.perf_counter()
+            for i in range(0, len(windows), batch_size):
+                logits = early(windows[i:i + batch_size])
+                logits[:, function.embed.indexer.unknown_index] = float("-inf")
+                top = logits.topk(k, dim=-1).indices
+                hits += (top == targets[i:i + batch_size].unsqueeze(1)).any(dim=1).sum().item()
+            seconds = time.perf_counter() - start
+        total = max(len(windows), 1)
+        rows.append({"threshold": threshold, "top{}_accuracy".format(k): hits / total,
+                     "ms_per_line": 1000 * seconds / total,
+                     "exits": [early.exits[i] / total for i in range(len(function.attention_layers()))]})
+    return rows
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    import myprogram
+    import quantization
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    train_parser = subparsers.add_parser("train", help="fit per-layer exit heads on a frozen checkpoint")
+    train_parser.add_argument("lang", choices=sorted(myprogram.CONFIGS))
+    train_parser.add_argument("data", help="training text")
+    train_parser.add_argument("--steps", type=int, default=2000)
+    train_parser.add_argument("--batch_size", type=int, default=64)
+    train_parser.add_argument("--lr", type=float, default=1e-3)
+    report_parser = subparsers.add_parser("report", help="accuracy, latency and exit layers per threshold")
+    report_parser.add_argument("lang", choices=sorted(myprogram.CONFIGS))
+    report_parser.add_argument("data", help="held-out text")
+    report_parser.add_argument("--thresholds", type=float, nargs="*", default=[0.5, 0.7, 0.8, 0.9, 0.95, 1.01])
+    report_parser.add_argument("--limit", type=int, default=8192)
+    report_parser.add_argument("--shared_head", action="store_true", help="ignore trained exit heads")
+    args = parser.parse_args()
+
+    config = myprogram.CONFIGS[args.lang]
+    function = myprogram.load_model(config).eval()
+    heads_path = exit_heads_path(config.chkpt_path, args.lang)
+    if args.mode == "train":
+        dataset = text_dataset.TextDataset(config.sequence_length + 1, Path(args.data), function.embed.indexer)
+        heads = train_exit_heads(function, dataset, args.steps, args.batch_size, args.lr)
+        print("Writing {}".format(heads_path))
+        torch.save(heads.state_dict(), heads_path)
+    else:
+        heads = None
+        if not args.shared_head and os.path.exists(heads_path):
+            heads = load_exit_heads(function, heads_path)
+        windows, targets = quantization.heldout_windows(Path(args.data), function.embed.indexer,
+                                                        config.sequence_length, args.limit, stride=61)
+        print("{} windows, {} heads".format(len(windows), "shared" if heads is None else "trained"))
+        for row in sweep(function, heads, windows, targets, args.thresholds):
+            print("threshold {threshold:.2f}: top-3 {top3_accuracy:.4f}, {ms_per_line:.3f} ms/line, exits {exits}"
+                  .format(**dict(row, exits=" ".join("{:.2f}".format(share) for share in row["exits"]))))
@@ -0,0 +1,162 @@
+import dataclasses
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+import data_util
+import model
+import text_dataset
+
+
+def window_starts(count: int, length: int, mode: str, stride: int) -> np.ndarray:
+    # "all" scores every position of back-to-back windows, so each symbol after the first is a target once;
+    # "last" only scores the symbol after each window, with a full `length` of context
+    if mode == "all":
+        return np.arange(0, max(count - length, 0), length, dtype=np.int64)
+    return np.arange(0, max(count - length, 0), stride, dtype=np.int64)
+
+
+def count_hits(function: model.BasicModel, tokens: np.ndarray, starts: np.ndarray, k: int, mode: str = "all",
+               batch_size: int = 256) -> Tuple[np.ndarray, int]:
+    # returns (hits[r] = targets within the top r + 1 predictions, number of targets)
+    length = function.pe.pe.size(1)
+    unknown = function.embed.indexer.unknown_index
+    data = torch.from_numpy(tokens)
+    offsets = torch.arange(length + 1)
+    hits = torch.zeros(k, dtype=torch.long)
+    total = 0
+    with torch.inference_mode():
+        for i in range(0, len(starts), batch_size):
+            block = data[torch.from_numpy(starts[i:i + batch_size]).unsqueeze(1) + offsets].long()
+            logits, targets = function(block[:, :-1]), block[:, 1:]
+            if mode == "last":
+                logits, targets = logits[:, -1:], targets[:, -1:]
+            # MyModel never emits the unknown symbol, so it cannot count as a hit here either
+            logits[..., unknown] = float("-inf")
+            top = torch.topk(logits, k, dim=-1).indices
+            hits += (top == targets.unsqueeze(-1)).cumsum(-1).clamp(max=1).reshape(-1, k).sum(0)
+            total += targets.numel()
+    return hits.numpy(), total
+
+
+@dataclasses.dataclass
+class EvalJob:
+    name: str
+    lang: str
+    chkpt_path: str
+    data_path: str
+    encoded_path: str = ""
+
+
+_WORKER_MODELS: Dict[Tuple[str, str], model.BasicModel] = {}
+
+
+def _load(lang: str, chkpt_path: str, quantize: bool, fuse: bool) -> model.BasicModel:
+    import myprogram
+
+    key = (lang, chkpt_path)
+    if key not in _WORKER_MODELS:
+        config = dataclasses.replace(myprogram.CONFIGS[lang], chkpt_path=chkpt_path)
+        _WORKER_MODELS[key] = myprogram.load_model(config, quantize=quantize, fuse=fuse).eval()
+    return _WORKER_MODELS[key]
+
+
+def _evaluate_shard(task) -> Tuple[int, np.ndarray, int]:
+    index, job, starts, k, mode, batch_size, quantize, fuse = task
+    function = _load(job.lang, job.chkpt_path, quantize, fuse)
+    tokens = text_dataset.open_encoded(Path(job.encoded_path), function.embed.indexer.dtype)
+    hits, total = count_hits(function, tokens, starts, k, mode, batch_size)
+    return index, hits, total
+
+
+def evaluate(jobs: List[EvalJob], k: int = 3, mode: str = "all", stride: int = 1, batch_size: int = 256,
+             workers: int = 1, shard_windows: int = 16384, quantize: bool = False,
+             fuse: bool = False) -> List[Dict[str, object]]:
+    # every job is cut into shards of `shard_windows` windows, and the shards of all jobs share one pool
+    tasks = []
+    for index, job in enumerate(jobs):
+        indexer = data_util.LANGUAGE_INDEXERS[job.lang]()
+        job.encoded_path = str(text_dataset.encode_corpus(Path(job.data_path), indexer))
+        count = os.path.getsize(job.encoded_path) // indexer.dtype.itemsize
+        length = _load(job.lang, job.chkpt_path, quantize, fuse).pe.pe.size(1)
+        starts = window_starts(count, length, mode, stride)
+        for i in range(0, len(starts), shard_windows):
+            tasks.append((index, job, starts[i:i + shard_windows], k, mode, batch_size, quantize, fuse))
+
+    hits = [np.zeros(k, dtype=np.int64) for _ in jobs]
+    totals = [0] * len(jobs)
+    if workers > 1:
+        # forked workers inherit the models loaded above
+        threads = max(1, torch.get_num_threads() // workers)
+        with multiprocessing.get_context("fork").Pool(workers, initializer=torch.set_num_threads,
+                                                      initargs=(threads,)) as pool:
+            results = pool.imap_unordered(_evaluate_shard, tasks)
+            for index, shard_hits, shard_total in results:
+                hits[index] += shard_hits
+                totals[index] += shard_total
+    else:
+        for task in tasks:
+            index, shard_hits, shard_total = _evaluate_shard(task)
+            hits[index] += shard_hits
+            totals[index] += shard_total
+
+    reports = []
+    for job, job_hits, total in zip(jobs, hits, totals):
+        report = {"name": job.name, "lang": job.lang, "checkpoint": job.chkpt_path, "data": job.data_path,
+                  "targets": total}
+        report.update({"top{}".format(r + 1): int(job_hits[r]) / max(total, 1) for r in range(k)})
+        reports.append(report)
+    return reports
+
+
+def parse_jobs(specs: List[str], checkpoints: List[str]) -> List[EvalJob]:
+    # specs are LANG=DATA; every --checkpoints LANG=PATH for that language is evaluated on its data,
+    # and the language's configured checkpoint is used when none is given
+    import myprogram
+
+    overrides: Dict[str, List[str]] = {}
+    for item in checkpoints:
+        lang, path = item.split("=", 1)
+        overrides.setdefault(lang, []).append(path)
+    jobs = []
+    for spec in specs:
+        lang, data_path = spec.split("=", 1)
+        for chkpt_path in overrides.get(lang, [myprogram.CONFIGS[lang].chkpt_path]):
+            jobs.append(EvalJob("{}:{}".format(lang, Path(chkpt_path).stem), lang, chkpt_path, data_path))
+    return jobs
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("data", nargs="+", metavar="LANG=PATH", help="held-out text per language")
+    parser.add_argument("--checkpoints", nargs="*", default=[], metavar="LANG=PATH",
+                        help="checkpoints to evaluate instead of the configured one; repeat a language to compare")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--mode", choices=("all", "last"), default="all",
+                        help="score every position of each window, or only the symbol after it")
+    parser.add_argument("--stride", type=int, default=1, help="window step in last mode")
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--fuse", action="store_true")
+    parser.add_argument("--output", default=None, help="also write the results as JSON")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    reports = evaluate(parse_jobs(args.data, args.checkpoints), k=args.k, mode=args.mode, stride=args.stride,
+                       batch_size=args.batch_size, workers=args.workers, quantize=args.quantize, fuse=args.fuse)
+    for report in reports:
+        print("{}: {} targets, ".format(report["name"], report["targets"]) +
+              ", ".join("top{} {:.4f}".format(r + 1, report["top{}".format(r + 1)]) for r in range(args.k)))
+    print("{:.2f} s".format(time.perf_counter() - start))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
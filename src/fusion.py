@@ -0,0 +1,55 @@
+import os
+import time
+
+import torch
+
+import data_util
+import model
+
+
+def fused_path(chkpt_path: str) -> str:
+    return os.path.splitext(chkpt_path)[0] + ".fused.pt"
+
+
+def save_fused(function: model.BasicModel, path: str):
+    torch.save(function.state_dict(), path)
+
+
+def load_fused(length: int, indexer: data_util.SymbolIndexer, dim: int, path: str,
+               device: str = "cpu") -> model.BasicModel:
+    function = model.fuse_attention(model.BasicModel(length, indexer, dim))
+    function.load_state_dict(torch.load(path, map_location=device))
+    return function.eval()
+
+
+def compare(function: model.BasicModel, fused: model.BasicModel, batch_size: int = 64, repeats: int = 20):
+    length = function.pe.pe.size(1)
+    x = torch.randint(0, function.embed.indexer.size(), (batch_size, length))
+    with torch.inference_mode():
+        max_error = (function(x) - fused(x)).abs().max().item()
+        timings = []
+        for candidate in (function, fused):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                candidate(x)
+            timings.append(1000 * (time.perf_counter() - start) / repeats)
+    return max_error, timings
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    import myprogram
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--langs", nargs="*", choices=sorted(myprogram.CONFIGS), default=sorted(myprogram.CONFIGS))
+    args = parser.parse_args()
+
+    for lang in args.langs:
+        config = myprogram.CONFIGS[lang]
+        function = myprogram.load_model(config).eval()
+        fused = model.fuse_attention(function)
+        max_error, (unfused_ms, fused_ms) = compare(function, fused)
+        path = fused_path(config.chkpt_path)
+        print("{}: max |logit difference| {:.2e}, {:.2f} -> {:.2f} ms per batch, writing {}".format(
+            lang, max_error, unfused_ms, fused_ms, path))
+        save_fused(fused, path)
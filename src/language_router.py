@@ -0,0 +1,87 @@
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from langid.langid import LanguageIdentifier
+
+
+LATIN_LANGUAGES = ['en', 'es', 'fr', 'no']
+
+# (first codepoint, last codepoint, script)
+SCRIPT_RANGES = [
+    (0x0041, 0x005A, 'latin'),
+    (0x0061, 0x007A, 'latin'),
+    (0x00C0, 0x024F, 'latin'),
+    (0x0400, 0x052F, 'cyrillic'),
+    (0x0900, 0x097F, 'devanagari'),
+    (0x3040, 0x30FF, 'kana'),
+    (0x31F0, 0x31FF, 'kana'),
+    (0xFF66, 0xFF9F, 'kana'),
+    (0x3400, 0x4DBF, 'han'),
+    (0x4E00, 0x9FFF, 'han'),
+    (0xF900, 0xFAFF, 'han'),
+]
+
+SCRIPT_LANGUAGES = {'cyrillic': 'ru', 'devanagari': 'hi', 'kana': 'ja', 'han': 'zh'}
+
+
+def script_of(symbol: str) -> Optional[str]:
+    codepoint = ord(symbol)
+    for first, last, script in SCRIPT_RANGES:
+        if first <= codepoint <= last:
+            return script
+    return None
+
+
+def latin_identifier(langs: List[str] = LATIN_LANGUAGES) -> "LanguageIdentifier":
+    # langid unpacks its model on import, and most lines are routed by script without it
+    from langid.langid import LanguageIdentifier, model as langid_model
+
+    identifier = LanguageIdentifier.from_modelstring(langid_model, norm_probs=False)
+    identifier.set_languages(langs)
+    return identifier
+
+
+class LanguageRouter:
+    def __init__(self, cache_size: int = 1 << 16):
+        self.cache_size = cache_size
+        self.counts = Counter()
+        self._cache: OrderedDict = OrderedDict()
+        self._identifier: Optional["LanguageIdentifier"] = None
+
+    def _script_language(self, line: str) -> Optional[str]:
+        scripts = Counter(script_of(symbol) for symbol in line)
+        scripts.pop(None, None)
+        if scripts['kana'] > 0:
+            return 'ja'
+        if not scripts:
+            return None
+        script, _ = scripts.most_common(1)[0]
+        return SCRIPT_LANGUAGES.get(script)
+
+    def _classify_latin(self, line: str) -> str:
+        if self._identifier is None:
+            self._identifier = latin_identifier()
+        return self._identifier.classify(line)[0]
+
+    def route(self, line: str) -> str:
+        lang = self._cache.get(line)
+        if lang is not None:
+            self._cache.move_to_end(line)
+            self.counts['cache'] += 1
+            return lang
+
+        lang = self._script_language(line)
+        if lang is not None:
+            self.counts['script'] += 1
+        else:
+            lang = self._classify_latin(line)
+            self.counts['langid'] += 1
+
+        self._cache[line] = lang
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return lang
+
+    def stats(self) -> Dict[str, int]:
+        return {tier: self.counts[tier] for tier in ('cache', 'script', 'langid')}
@@ -1,25 +1,59 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import pytorch_lightning as pl
+from pytorch_lightning.utilities.cloud_io import load as pl_load
+from typing import Optional
+
+
+def sampled_softmax_loss(hidden: torch.Tensor, target: torch.Tensor, out: nn.Linear, num_sampled: int) -> torch.Tensor:
+    # scores each position against its target and num_sampled classes shared across the batch; sampling
+    # uniformly without replacement gives every class the same inclusion probability, so no log-q correction
+    D, E = out.weight.size()
+    hidden = hidden.reshape(-1, E)
+    target = target.reshape(-1)
+    negatives = torch.randperm(D, device=hidden.device)[:num_sampled]
+
+    true_logits = (hidden * out.weight[target]).sum(dim=-1, keepdim=True) + out.bias[target].unsqueeze(1)
+    sampled_logits = hidden @ out.weight[negatives].t() + out.bias[negatives]
+    sampled_logits = sampled_logits.masked_fill(negatives.unsqueeze(0) == target.unsqueeze(1), float('-inf'))
+    logits = torch.cat([true_logits, sampled_logits], dim=1)
+    return F.cross_entropy(logits, torch.zeros_like(target)) / logits.size(-1)
 
 
 class LightningWrapper(pl.LightningModule):
-    def __init__(self, f):
+    def __init__(self, f, num_sampled: Optional[int] = None):
         super().__init__()
         self.f = f
+        self.num_sampled = num_sampled
 
     def forward(self, x):
         return self.f(x)
 
-    def training_step(self, batch: torch.Tensor, _):
-        true = self.f.embed.one_hot(batch)[:, 1:, :]
-        pred = F.log_softmax(self.f(batch)[:, :-1, :], dim=-1)
-        loss = -(true * pred).mean()
+    def training_step(self, batch, _):
+        f = self.f
+        if isinstance(batch, (list, tuple)):
+            # MultilingualDataset batches are (language index, windows) drawn from a single language
+            langs, batch = batch
+            f = self.f.view(self.f.languages[langs[0].item()])
+
+        target = batch[:, 1:].long()
+        if self.num_sampled is not None and self.num_sampled < f.out.out_features - 1:
+            loss = sampled_softmax_loss(f.features(batch)[:, :-1, :], target, f.out, self.num_sampled)
+        else:
+            pred = f(batch)[:, :-1, :]
+            # cross entropy over the alphabet size is the previous -(one_hot * log_softmax).mean()
+            loss = F.cross_entropy(pred.reshape(-1, pred.size(-1)), target.reshape(-1)) / pred.size(-1)
 
         self.log("train_loss", loss)
         return {"loss": loss}
 
     def configure_optimizers(self):
         optimizer = optim.Adadelta(self.parameters(), lr=1.0)
-        return optimizer
\ No newline at end of file
+        return optimizer
+
+
+def load_state_dict(chkpt_path: str, map_location: str) -> dict:
+    # the model weights of a checkpoint, keyed as in LightningWrapper.state_dict()
+    return pl_load(chkpt_path, map_location=map_location)["state_dict"]
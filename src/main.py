@@ -12,19 +12,38 @@ import text_dataset
 if __name__ == "__main__":
     sequence_length = 64
     embed_dim = 192
+    num_sampled = None  # e.g. 128 to train large alphabets with a sampled softmax
 
-    train_path = Path("data") / Path("cleanhindi.txt")
+    # any number of files, plain or .gz/.bz2/.xz, streamed rather than loaded, so the corpus can outgrow RAM
+    train_paths = sorted(Path("data").glob("cleanhindi*.txt*"))
     # with open(train_path) as train_data:
     #     indexer = data_util.SymbolIndexer(train_data.read())
     #     print(indexer.size())
     #     print(indexer._known_symbol_to_index)
     indexer = data_util.SymbolIndexer.hindi()
 
-    dataset = text_dataset.TextDataset(sequence_length, train_path, indexer=indexer)
-    function = model.BasicModel(sequence_length, indexer, embed_dim)
+    # more than one entry trains a single MultilingualModel over all of them, e.g.
+    # {"en": Path("data") / Path("english.txt"), "hi": Path("data") / Path("cleanhindi.txt")}
+    multilingual_train_paths = {}
 
-    loader = torch.utils.data.DataLoader(dataset, batch_size=128, num_workers=6, shuffle=True)
+    if multilingual_train_paths:
+        datasets = {lang: text_dataset.TextDataset(sequence_length, path, indexer=data_util.LANGUAGE_INDEXERS[lang]())
+                    for lang, path in multilingual_train_paths.items()}
+        function = model.MultilingualModel(sequence_length, {lang: d.indexer for lang, d in datasets.items()},
+                                           embed_dim)
+        dataset = text_dataset.MultilingualDataset(datasets, function.languages)
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_sampler=text_dataset.LanguageBatchSampler(dataset, batch_size=128), num_workers=6)
+    else:
+        if not train_paths:
+            raise FileNotFoundError("no training files match data/cleanhindi*.txt*")
+        dataset = text_dataset.StreamingTextDataset(sequence_length, train_paths, indexer, batch_size=128)
+        function = model.BasicModel(sequence_length, indexer, embed_dim)
+
+        # the dataset shuffles and batches itself; each worker streams its own share of train_paths
+        loader = torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=6, pin_memory=True,
+                                             persistent_workers=True)
     checkpoint_callback = ModelCheckpoint(every_n_train_steps=1024)
     trainer = pl.Trainer(gpus=1, callbacks=[checkpoint_callback])
 
-    trainer.fit(lightning_wrapper.LightningWrapper(function), loader)
+    trainer.fit(lightning_wrapper.LightningWrapper(function, num_sampled=num_sampled), loader)
@@ -1,13 +1,47 @@
+import copy
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import data_util
 
 
-class ResidualSelfAttention(nn.Module):
+KVCache = Tuple[torch.Tensor, torch.Tensor]
+
+
+def split_heads(x: torch.Tensor, num_heads: int) -> torch.Tensor:
+    N, L, D = x.size()
+    return x.reshape(N, L, num_heads, D // num_heads).transpose(1, 2)
+
+
+def merge_heads(x: torch.Tensor) -> torch.Tensor:
+    N, H, L, E = x.size()
+    return x.transpose(1, 2).reshape(N, L, H * E)
+
+
+def attend(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, mask: torch.Tensor) -> torch.Tensor:
+    scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(q.size(-1)) + mask
+    return torch.matmul(F.softmax(scores, dim=-1), v)
+
+
+class IncrementalAttention(nn.Module):
+    # causal self-attention over a (possibly partial) window; subclasses provide num_heads,
+    # attn_mask, project (to post in-projection q, k, v) and output (residual update)
+    def forward_incremental(self, x: torch.Tensor, cache: Optional[KVCache] = None,
+                            start: int = 0) -> Tuple[torch.Tensor, KVCache]:
+        N, T, _ = x.size()
+        q, k, v = (split_heads(t, self.num_heads) for t in self.project(x))
+        if cache is not None:
+            assert cache[0].size(2) == start
+            k = torch.cat([cache[0], k], dim=2)
+            v = torch.cat([cache[1], v], dim=2)
+        o = attend(q, k, v, self.attn_mask[start:start + T, :start + T])
+        return self.output(x, merge_heads(o)), (k, v)
+
+
+class ResidualSelfAttention(IncrementalAttention):
     def __init__(self, length: int, dim: int, num_heads: int):
         super().__init__()
         self.alpha = nn.Parameter(torch.zeros([]))
@@ -26,10 +60,75 @@ class ResidualSelfAttention(nn.Module):
         q = self.q(x)
         k = self.k(x)
         v = self.v(x)
-        o, _ = self.mha(q, k, v, attn_mask=self.attn_mask)
+        # windows may be shorter than the model's length; positions are always counted from 0
+        L = x.size(1)
+        o, _ = self.mha(q, k, v, attn_mask=self.attn_mask[:L, :L])
         o = self.out(o)
         return x + self.alpha * F.relu(o)
 
+    def project(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        # outer q/k/v projections followed by the in-projection nn.MultiheadAttention applies
+        w_q, w_k, w_v = self.mha.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.mha.in_proj_bias.chunk(3)
+        return F.linear(self.q(x), w_q, b_q), F.linear(self.k(x), w_k, b_k), F.linear(self.v(x), w_v, b_v)
+
+    def output(self, x: torch.Tensor, o: torch.Tensor) -> torch.Tensor:
+        o = self.out(self.mha.out_proj(o))
+        return x + self.alpha * F.relu(o)
+
+    @property
+    def num_heads(self) -> int:
+        return self.mha.num_heads
+
+
+class FusedResidualSelfAttention(IncrementalAttention):
+    # inference-only ResidualSelfAttention with the outer q/k/v projections folded into the
+    # MultiheadAttention in-projection, out_proj folded into out, and |alpha| folded into out,
+    # using alpha * relu(o) == sign(alpha) * relu(|alpha| * o)
+    def __init__(self, length: int, dim: int, num_heads: int):
+        super().__init__()
+        self.num_heads = num_heads
+        self.in_proj = nn.Linear(dim, 3 * dim)
+        self.out = nn.Linear(dim, dim)
+        self.register_buffer("sign", torch.ones([]))
+
+        mask = torch.ones(length, length).tril() >= 0.5
+        mask = mask.float().masked_fill(mask.logical_not(),
+                                        float('-inf')).masked_fill(mask, float(0.0))
+        self.register_buffer("attn_mask", mask)
+
+    @classmethod
+    def fold(cls, layer: ResidualSelfAttention) -> "FusedResidualSelfAttention":
+        length, dim = layer.attn_mask.size(0), layer.q.in_features
+        fused = cls(length, dim, layer.num_heads).to(layer.attn_mask.device)
+        with torch.no_grad():
+            in_weights = layer.mha.in_proj_weight.double().chunk(3)
+            in_biases = layer.mha.in_proj_bias.double().chunk(3)
+            weights, biases = [], []
+            for outer, w_in, b_in in zip((layer.q, layer.k, layer.v), in_weights, in_biases):
+                weights.append(w_in @ outer.weight.double())
+                biases.append(w_in @ outer.bias.double() + b_in)
+            fused.in_proj.weight.copy_(torch.cat(weights))
+            fused.in_proj.bias.copy_(torch.cat(biases))
+
+            alpha = layer.alpha.double()
+            w_out = layer.out.weight.double() @ layer.mha.out_proj.weight.double()
+            b_out = layer.out.weight.double() @ layer.mha.out_proj.bias.double() + layer.out.bias.double()
+            fused.out.weight.copy_(alpha.abs() * w_out)
+            fused.out.bias.copy_(alpha.abs() * b_out)
+            fused.sign.copy_(torch.sign(alpha))
+            fused.attn_mask.copy_(layer.attn_mask)
+        return fused
+
+    def project(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        return self.in_proj(x).chunk(3, dim=-1)
+
+    def output(self, x: torch.Tensor, o: torch.Tensor) -> torch.Tensor:
+        return x + self.sign * F.relu(self.out(o))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.forward_incremental(x)[0]
+
 
 class EmbeddingLayer(nn.Module):
     def __init__(self, indexer: data_util.SymbolIndexer, dim: int):
@@ -53,6 +152,12 @@ class EmbeddingLayer(nn.Module):
         _, indices = torch.topk(x, k, sorted=True)
         return [self.indexer.to_symbol(i.item()) for i in indices]
 
+    def interpret_batch(self, x: torch.Tensor, k: int = 3) -> List[List[Optional[str]]]:
+        N, D = x.size()
+        assert D == self.indexer.size()
+        _, indices = torch.topk(x, k, dim=-1, sorted=True)
+        return [[self.indexer.to_symbol(i) for i in row] for row in indices.tolist()]
+
     def forward(self, x: torch.ByteTensor) -> torch.Tensor:
         N, L = x.size()
         D = self.dim
@@ -74,8 +179,8 @@ class PELayer(nn.Module):
         pe = pe.transpose(0, 1)
         self.register_buffer('pe', pe)
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
-        return x + self.pe
+    def forward(self, x: torch.Tensor, start: int = 0) -> torch.Tensor:
+        return x + self.pe[:, start:start + x.size(1)]
 
 
 class BasicModel(nn.Module):
@@ -89,12 +194,102 @@ class BasicModel(nn.Module):
         self.attention_3 = ResidualSelfAttention(length, dim, 4)
         self.out = nn.Linear(dim, indexer.size())
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def features(self, x: torch.Tensor) -> torch.Tensor:
         x = self.embed(x)
         x = self.pe(x)
         x = self.attention_0(x)
         x = self.attention_1(x)
         x = self.attention_2(x)
         x = self.attention_3(x)
+        return x
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        x = self.features(x)
         x = self.out(x)
         return x
+
+    def attention_layers(self) -> List[IncrementalAttention]:
+        return [self.attention_0, self.attention_1, self.attention_2, self.attention_3]
+
+    def forward_incremental(self, x: torch.Tensor, cache: Optional[List[KVCache]] = None,
+                            start: int = 0) -> Tuple[torch.Tensor, List[KVCache]]:
+        # x holds the symbols at positions [start, start + T) of the window; cache holds the
+        # per-layer keys and values of positions [0, start)
+        x = self.embed(x)
+        x = self.pe(x, start)
+        new_cache = []
+        for i, layer in enumerate(self.attention_layers()):
+            x, kv = layer.forward_incremental(x, None if cache is None else cache[i], start)
+            new_cache.append(kv)
+        return self.out(x), new_cache
+
+
+class MultilingualModel(nn.Module):
+    # one positional encoding and attention stack shared by every language, with a per-language
+    # embedding and output head over that language's SymbolIndexer alphabet
+    def __init__(self, length: int, indexers: Dict[str, data_util.SymbolIndexer], dim: int):
+        super().__init__()
+        self.languages = sorted(indexers)
+        self.pe = PELayer(length, dim)
+        self.attention_0 = ResidualSelfAttention(length, dim, 4)
+        self.attention_1 = ResidualSelfAttention(length, dim, 4)
+        self.attention_2 = ResidualSelfAttention(length, dim, 4)
+        self.attention_3 = ResidualSelfAttention(length, dim, 4)
+        self.embeds = nn.ModuleDict({lang: EmbeddingLayer(indexers[lang], dim) for lang in self.languages})
+        self.outs = nn.ModuleDict({lang: nn.Linear(dim, indexers[lang].size()) for lang in self.languages})
+        self._views: Dict[str, LanguageView] = {}
+
+    def attention_layers(self) -> List[IncrementalAttention]:
+        return [self.attention_0, self.attention_1, self.attention_2, self.attention_3]
+
+    def view(self, lang: str) -> "LanguageView":
+        if lang not in self._views:
+            self._views[lang] = LanguageView(self, lang)
+        return self._views[lang]
+
+    def forward(self, x: torch.Tensor, lang: str) -> torch.Tensor:
+        return self.view(lang)(x)
+
+
+class LanguageView(BasicModel):
+    # a BasicModel over one language of a MultilingualModel; every submodule is shared, not copied
+    def __init__(self, backbone: MultilingualModel, lang: str):
+        nn.Module.__init__(self)
+        self.embed = backbone.embeds[lang]
+        self.pe = backbone.pe
+        self.attention_0 = backbone.attention_0
+        self.attention_1 = backbone.attention_1
+        self.attention_2 = backbone.attention_2
+        self.attention_3 = backbone.attention_3
+        self.out = backbone.outs[lang]
+
+
+def fuse_attention(function: BasicModel) -> BasicModel:
+    fused = copy.deepcopy(function)
+    for i, layer in enumerate(function.attention_layers()):
+        setattr(fused, "attention_{}".format(i), FusedResidualSelfAttention.fold(layer))
+    return fused
+
+
+class IncrementalDecoder:
+    # keeps the keys and values of the last window it ran. Positional encodings are absolute within the
+    # window, so only a window that extends that one (the same symbols at the same positions) reuses them;
+    # any other window, e.g. one that slid, runs again from scratch
+    def __init__(self, model: BasicModel):
+        self.model = model
+        self.text = ""
+        self.cache: Optional[List[KVCache]] = None
+        self.logits: Optional[torch.Tensor] = None
+
+    def decode(self, window: str) -> torch.Tensor:
+        # logits after the last symbol of window
+        if not (self.text and window.startswith(self.text)):
+            self.text, self.cache = "", None
+        text = window[len(self.text):]
+        if text:
+            x = torch.from_numpy(self.model.embed.indexer.encode(text)).unsqueeze(0)
+            with torch.inference_mode():
+                y, self.cache = self.model.forward_incremental(x, self.cache, start=len(self.text))
+            self.text = window
+            self.logits = y[0, -1]
+        return self.logits
@@ -0,0 +1,93 @@
+from pathlib import Path
+from typing import Dict
+
+import torch
+import torch.nn as nn
+
+import array_bundle
+import data_util
+import model
+
+
+# every language's BasicModel weights and alphabet in one array bundle; the header's "languages" holds
+# what MyModelConfig needs besides them
+BUNDLE_FORMAT = "model-bundle"
+BUNDLE_FORMAT_VERSION = 1
+
+
+def bundle_path(work_dir: str) -> Path:
+    return Path(work_dir) / "models.bundle"
+
+
+def export_bundle(path: Path, functions: Dict[str, model.BasicModel], dummy_prompts: Dict[str, str]):
+    arrays = {}
+    languages = {}
+    for lang, function in functions.items():
+        blob, offsets = array_bundle.strings_to_arrays(function.embed.indexer.symbols)
+        arrays["symbols/" + lang], arrays["symbols_offsets/" + lang] = blob, offsets
+        for name, tensor in function.state_dict().items():
+            arrays["weights/{}/{}".format(lang, name)] = tensor.detach().cpu().numpy()
+        languages[lang] = {"sequence_length": function.pe.pe.size(1), "embed_dim": function.embed.dim,
+                           "dummy_prompt": dummy_prompts[lang]}
+    array_bundle.write_bundle(path, arrays, {"format": BUNDLE_FORMAT, "version": BUNDLE_FORMAT_VERSION,
+                                             "languages": languages})
+
+
+class ModelBundle:
+    def __init__(self, path: Path):
+        # mapped copy-on-write so the weights can go through torch.from_numpy without a copy or warning
+        meta, self.arrays = array_bundle.read_bundle(path, writable=True)
+        if meta.get("format") != BUNDLE_FORMAT or meta.get("version") != BUNDLE_FORMAT_VERSION:
+            raise ValueError("{} is not a version {} {} file".format(path, BUNDLE_FORMAT_VERSION, BUNDLE_FORMAT))
+        self.path = path
+        self.languages: Dict[str, Dict[str, object]] = meta["languages"]
+
+    def indexer(self, lang: str) -> data_util.SymbolIndexer:
+        return data_util.SymbolIndexer(array_bundle.arrays_to_strings(self.arrays["symbols/" + lang],
+                                                                      self.arrays["symbols_offsets/" + lang]))
+
+    def load(self, lang: str) -> model.BasicModel:
+        # the mapped arrays themselves become the parameters and buffers, so the weights are never copied:
+        # processes (and reloads after an eviction) share the same page-cache pages. Swapped in by hand rather
+        # than with load_state_dict(assign=True), which torch 1.9 does not have
+        spec = self.languages[lang]
+        function = model.BasicModel(spec["sequence_length"], self.indexer(lang), spec["embed_dim"])
+        prefix = "weights/{}/".format(lang)
+        weights = {name[len(prefix):]: torch.from_numpy(array)
+                   for name, array in self.arrays.items() if name.startswith(prefix)}
+        expected = function.state_dict()
+        if weights.keys() != expected.keys():
+            raise ValueError("{} does not match BasicModel for {}: missing {}, unexpected {}".format(
+                self.path, lang, sorted(expected.keys() - weights.keys()), sorted(weights.keys() - expected.keys())))
+        for name, tensor in weights.items():
+            # scalars come back from the bundle with shape (1,); the reshape is a view, not a copy
+            if tensor.shape != expected[name].shape and tensor.numel() == expected[name].numel():
+                tensor = tensor.reshape(expected[name].shape)
+            if tensor.shape != expected[name].shape:
+                raise ValueError("{} has {} of shape {} for {}, expected {}".format(
+                    self.path, name, tuple(tensor.shape), lang, tuple(expected[name].shape)))
+            owner_name, _, leaf = name.rpartition(".")
+            owner = function
+            for part in owner_name.split(".") if owner_name else []:
+                owner = getattr(owner, part)
+            if leaf in owner._parameters:
+                owner._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+            else:
+                owner._buffers[leaf] = tensor
+        return function.eval()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    import myprogram
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--work_dir", default="work")
+    parser.add_argument("--output", default=None, help="where to write the bundle (default: <work_dir>/models.bundle)")
+    parser.add_argument("--langs", nargs="*", choices=sorted(myprogram.CONFIGS), default=sorted(myprogram.CONFIGS))
+    args = parser.parse_args()
+
+    path = Path(args.output) if args.output is not None else bundle_path(args.work_dir)
+    functions = {lang: myprogram.load_model(myprogram.CONFIGS[lang]).eval() for lang in args.langs}
+    print("Writing {} languages to {}".format(len(functions), path))
+    export_bundle(path, functions, {lang: myprogram.CONFIGS[lang].dummy_prompt for lang in args.langs})
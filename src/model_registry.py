@@ -0,0 +1,97 @@
+import contextlib
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set
+
+import torch
+import torch.nn as nn
+
+
+def tensor_bytes(module: nn.Module) -> Dict[int, int]:
+    # walks the state dict rather than parameters() so int8 packed weights are counted too; keyed by data
+    # pointer, so tensors shared between modules (the backbone of MultilingualModel's language views) and
+    # within one are only counted once
+    sizes = {}
+    for value in module.state_dict().values():
+        for t in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(t, torch.Tensor):
+                sizes[t.data_ptr()] = max(sizes.get(t.data_ptr(), 0), t.numel() * t.element_size())
+    return sizes
+
+
+def model_bytes(module: nn.Module) -> int:
+    return sum(tensor_bytes(module).values())
+
+
+class ModelRegistry:
+    def __init__(self, loader: Callable[[str], nn.Module], max_models: Optional[int] = None,
+                 max_bytes: Optional[int] = None, warm_up: Iterable[str] = ()):
+        assert max_models is None or max_models >= 1
+        self.loader = loader
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.loads = 0
+        self.evictions = 0
+        self._models: OrderedDict = OrderedDict()
+        self._sizes: Dict[str, Dict[int, int]] = {}
+        self._pinned: Set[str] = set()
+        self.warm_up(warm_up)
+
+    def warm_up(self, keys: Iterable[str]):
+        for key in keys:
+            self[key]
+
+    @contextlib.contextmanager
+    def pinned(self, keys: Iterable[str]) -> Iterator[None]:
+        # loads keys and keeps them resident until the block exits, past max_models / max_bytes if need be
+        keys = [key for key in keys if key not in self._pinned]
+        self._pinned.update(keys)
+        try:
+            self.warm_up(keys)
+            yield
+        finally:
+            self._pinned.difference_update(keys)
+            self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._models
+
+    def __getitem__(self, key: str) -> nn.Module:
+        if key in self._models:
+            self._models.move_to_end(key)
+            return self._models[key]
+
+        module = self.loader(key)
+        self.loads += 1
+        self._models[key] = module
+        self._sizes[key] = tensor_bytes(module)
+        self._evict()
+        return module
+
+    def over_budget(self) -> bool:
+        if self.max_models is not None and len(self._models) > self.max_models:
+            return True
+        return self.max_bytes is not None and self.resident_bytes() > self.max_bytes
+
+    def _evict(self):
+        # the most recently requested model and pinned models always stay resident, even if they alone
+        # exceed the budget
+        while self.over_budget():
+            key = next((key for key in list(self._models)[:-1] if key not in self._pinned), None)
+            if key is None:
+                break
+            del self._models[key]
+            del self._sizes[key]
+            self.evictions += 1
+
+    def resident(self) -> List[str]:
+        return list(self._models)
+
+    def resident_bytes(self) -> int:
+        resident = {}
+        for sizes in self._sizes.values():
+            resident.update(sizes)
+        return sum(resident.values())
+
+    def stats(self) -> Dict[str, object]:
+        return {"resident": self.resident(), "resident_bytes": self.resident_bytes(),
+                "loads": self.loads, "evictions": self.evictions}
@@ -1,22 +1,37 @@
 #!/usr/bin/env python
+import functools
+import multiprocessing
 import os
 import string
-from matplotlib import interactive
+import weakref
 import torch
 import random
+from collections import Counter
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from typing import TYPE_CHECKING
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 import data_util
+import early_exit
 import model
-import lightning_wrapper
-from langid import set_languages, classify
+import language_router
+import model_bundle
+import model_registry
+import prediction_cache
+import fusion
+import profiling
+import quantization
+
+if TYPE_CHECKING:
+    # the n-gram tables (cascade -> predict -> train_helper) are only needed with --ngram
+    import cascade
 
 
 DEVICE = 'cpu'
 
 @dataclass
 class MyModelConfig:
+    indexer: Callable[[], data_util.SymbolIndexer]
     dummy_prompt: str
     device: str
     chkpt_path: str
@@ -27,52 +42,172 @@ class MyModelConfig:
         assert len(self.dummy_prompt) >= self.sequence_length
 
 
-class MyModel:
-    def __init__(self):
-        english_model = model.BasicModel(CONFIG_ENGLISH.sequence_length,
-                                data_util.SymbolIndexer.english(), CONFIG_ENGLISH.embed_dim)
-        english_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_ENGLISH.chkpt_path, map_location=CONFIG_ENGLISH.device, f=english_model)
-
-        spanish_model = model.BasicModel(CONFIG_SPANISH.sequence_length,
-                                data_util.SymbolIndexer.spanish(), CONFIG_SPANISH.embed_dim)
-        spanish_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_SPANISH.chkpt_path, map_location=CONFIG_SPANISH.device, f=spanish_model)
-
-        russian_model = model.BasicModel(CONFIG_RUSSIAN.sequence_length,
-                                data_util.SymbolIndexer.russian(), CONFIG_RUSSIAN.embed_dim)
-        russian_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_RUSSIAN.chkpt_path, map_location=CONFIG_RUSSIAN.device, f=russian_model)
-
-        japanese_model = model.BasicModel(CONFIG_JAPANESE.sequence_length,
-                                data_util.SymbolIndexer.japanese(), CONFIG_JAPANESE.embed_dim)
-        japanese_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_JAPANESE.chkpt_path, map_location=CONFIG_JAPANESE.device, f=japanese_model)
-        
-        norwegian_model = model.BasicModel(CONFIG_NORWEGIAN.sequence_length,
-                                           data_util.SymbolIndexer.norwegian(), CONFIG_NORWEGIAN.embed_dim)
-        norwegian_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_NORWEGIAN.chkpt_path, map_location=CONFIG_NORWEGIAN.device, f=norwegian_model)
-
-        chinese_model = model.BasicModel(CONFIG_CHINESE.sequence_length,
-                                           data_util.SymbolIndexer.chinese(), CONFIG_CHINESE.embed_dim)
-        chinese_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_CHINESE.chkpt_path, map_location=CONFIG_CHINESE.device, f=chinese_model)
-
-        hindi_model = model.BasicModel(CONFIG_HINDI.sequence_length,
-                                           data_util.SymbolIndexer.hindi(), CONFIG_HINDI.embed_dim)
-        hindi_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_HINDI.chkpt_path, map_location=CONFIG_HINDI.device, f=hindi_model)
-
-        french_model = model.BasicModel(CONFIG_FRENCH.sequence_length,
-                                           data_util.SymbolIndexer.french(), CONFIG_FRENCH.embed_dim)
-        french_model = lightning_wrapper.LightningWrapper.load_from_checkpoint(
-            CONFIG_FRENCH.chkpt_path, map_location=CONFIG_FRENCH.device, f=french_model)
-
-
-        self.my_models = {'en': english_model.f, 'es': spanish_model.f, 'ru': russian_model.f, 'ja': japanese_model.f, 'no': norwegian_model.f, 'zh': chinese_model.f, 'hi': hindi_model.f, 'fr': french_model.f}
-        self.configs = {'en': CONFIG_ENGLISH, 'es': CONFIG_SPANISH, 'ru': CONFIG_RUSSIAN, 'ja': CONFIG_JAPANESE, 'no': CONFIG_NORWEGIAN, 'zh': CONFIG_CHINESE, 'hi': CONFIG_HINDI, 'fr': CONFIG_FRENCH}
+def load_model(config: MyModelConfig, quantize: bool = False, fuse: bool = False) -> model.BasicModel:
+    if fuse and os.path.exists(fusion.fused_path(config.chkpt_path)):
+        function = fusion.load_fused(config.sequence_length, config.indexer(), config.embed_dim,
+                                     fusion.fused_path(config.chkpt_path), config.device)
+        return quantization.quantize_dynamic(function) if quantize else function
+    if quantize and not fuse and os.path.exists(quantization.quantized_path(config.chkpt_path)):
+        return quantization.load_quantized(config.sequence_length, config.indexer(), config.embed_dim,
+                                           quantization.quantized_path(config.chkpt_path), config.device)
+
+    # pytorch_lightning is slow to import, so only checkpoint loading pulls it in
+    import lightning_wrapper
+
+    function = model.BasicModel(config.sequence_length, config.indexer(), config.embed_dim)
+    function = lightning_wrapper.LightningWrapper.load_from_checkpoint(
+        config.chkpt_path, map_location=config.device, f=function).f
+    if fuse:
+        function = model.fuse_attention(function.eval())
+    return quantization.quantize_dynamic(function.eval()) if quantize else function
+
+
+def load_bundled(bundle: model_bundle.ModelBundle, lang: str, quantize: bool = False,
+                 fuse: bool = False) -> model.BasicModel:
+    function = bundle.load(lang)
+    if fuse:
+        function = model.fuse_attention(function)
+    return quantization.quantize_dynamic(function) if quantize else function
+
+
+def bundle_configs(bundle: model_bundle.ModelBundle) -> Dict[str, MyModelConfig]:
+    return {lang: MyModelConfig(indexer=functools.partial(bundle.indexer, lang), dummy_prompt=spec["dummy_prompt"],
+                                device=DEVICE, chkpt_path=str(bundle.path), sequence_length=spec["sequence_length"],
+                                embed_dim=spec["embed_dim"])
+            for lang, spec in bundle.languages.items()}
+
+
+def load_multilingual(chkpt_path: str, configs: Dict[str, MyModelConfig], quantize: bool = False,
+                      fuse: bool = False) -> model.MultilingualModel:
+    import lightning_wrapper
+
+    config = next(iter(configs.values()))
+    state_dict = lightning_wrapper.load_state_dict(chkpt_path, config.device)
+    languages = sorted({key.split(".")[2] for key in state_dict if key.startswith("f.embeds.")})
+    backbone = model.MultilingualModel(config.sequence_length, {lang: configs[lang].indexer() for lang in languages},
+                                       config.embed_dim)
+    lightning_wrapper.LightningWrapper(backbone).load_state_dict(state_dict)
+    # fused and quantized once, before any language view is taken, so the views still share every layer
+    if fuse:
+        backbone = model.fuse_attention(backbone.eval())
+    return quantization.quantize_dynamic(backbone.eval()) if quantize else backbone.eval()
+
 
+CONFIG_ENGLISH = MyModelConfig(
+    indexer=data_util.SymbolIndexer.english,
+    chkpt_path="work/english.ckpt",
+    dummy_prompt="in other words, living an eternity of just about anything is now more terrifying to me than death. ",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_SPANISH = MyModelConfig(
+    indexer=data_util.SymbolIndexer.spanish,
+    chkpt_path="work/spanish.ckpt",
+    dummy_prompt="Tomebamba también conocido como Tumipampa fue el centro administrativo del norte del Imperio inca, antes de la conquista Inca era el asentamiento cañari de Guapondelig. ",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_RUSSIAN = MyModelConfig(
+    indexer=data_util.SymbolIndexer.russian,
+    chkpt_path="work/russian.ckpt",
+    dummy_prompt="старейшее из существующих семейство с территории Южных Нидерландов, сначала баронское, затем княжеское. Упоминается на страницах источников с XII века. ",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_JAPANESE = MyModelConfig(
+    indexer=data_util.SymbolIndexer.japanese,
+    chkpt_path="work/japanese.ckpt",
+    dummy_prompt="ヒトにおいて19遺伝子存在するアルデヒドデヒドロゲナーゼ遺伝子の1つであり、コードしているALDH2タンパク質はヒトの肝臓を中心に様々な組織、細胞においてエタノールの代謝産物であるアセトアルデヒドを含む反応性アルデヒドの酸化および無毒化に重要な働きをしている酵素である",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_NORWEGIAN = MyModelConfig(
+    indexer=data_util.SymbolIndexer.norwegian,
+    chkpt_path="work/norwegian.ckpt",
+    dummy_prompt="ar ikke noe sånn vondt ment det ei nlle skulle rette opp så du en feil så skulle n kke sant a det internt og for at det skulle være bra når det ga ja da syns vi var veldig e det er veldig e fornø",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_CHINESE = MyModelConfig(
+    indexer=data_util.SymbolIndexer.chinese,
+    chkpt_path="work/chinese.ckpt",
+    dummy_prompt="是一种较弱的雌性甾体性激素，是三种主要的内源性雌激素之一，另外两种为雌二醇和雌三醇。雌酮等雌激素的生物合成从膽固醇开始，大部分由生殖腺分泌，少部分为脂肪組織对来自腎上腺的雄激素的转化。相对于雌二醇而言，雌酮和雌三醇的活性都很小。雌酮可转化为雌二醇，是主要的雌二醇代謝前体。 孩童+青春期 出生1-14 天：新生兒的雌酮水平在出生時非常高，但會在幾天內降至青春期前水平。 男性 #青春期開始",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_HINDI = MyModelConfig(
+    indexer=data_util.SymbolIndexer.hindi,
+    chkpt_path="work/hindi.ckpt",
+    dummy_prompt="प्रतिशत तक क्षाराभ पाए जाते हैं जिनमें रिसरपिन प्रमुख हैं इसका गुण रूक्ष, रस में तिक्त, विपाक में कटु और इसका प्रभाव निद्राजनक होता है।",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIG_FRENCH = MyModelConfig(
+    indexer=data_util.SymbolIndexer.french,
+    chkpt_path="work/french.ckpt",
+    dummy_prompt="Cette géométrie change significativement lors de la chélation : Les éthers couronnes peuvent être utilisés au laboratoire comme catalyseurs de transfert de phase, bien qu'il existe de tels catalyseurs moins chers et moins spécifiques. En présence de 18-C-6, le permanganate de potassium se dissout dans le benzène en donnant du benzène violet",
+    device=DEVICE,
+    sequence_length=64,
+    embed_dim=192,
+)
+
+CONFIGS = {'en': CONFIG_ENGLISH, 'es': CONFIG_SPANISH, 'ru': CONFIG_RUSSIAN, 'ja': CONFIG_JAPANESE, 'no': CONFIG_NORWEGIAN, 'zh': CONFIG_CHINESE, 'hi': CONFIG_HINDI, 'fr': CONFIG_FRENCH}
+
+
+class MyModel:
+    def __init__(self, max_models: Optional[int] = None, max_bytes: Optional[int] = None,
+                 warm_up: Iterable[str] = (), quantize: bool = False, fuse: bool = False,
+                 multilingual: Optional[str] = None, profiler: profiling.NullProfiler = profiling.NULL_PROFILER,
+                 cache_size: int = 1 << 16, bundle: Optional[str] = None,
+                 cascade_gates: Optional[Dict[str, "cascade.NGramGate"]] = None,
+                 exit_threshold: Optional[float] = None, padding: str = "cached"):
+        self.configs = CONFIGS
+        self.exit_threshold = exit_threshold
+        # "cached" reuses the dummy prompt's keys and values per pad length, "dummy" runs the padded window
+        # as ordinary tokens, "none" runs short lines unpadded
+        self.padding = padding
+        self.prefix_caches: Dict[Tuple[str, int], Tuple[weakref.ref, List[model.KVCache]]] = {}
+        self.exit_models: Dict[str, early_exit.EarlyExitModel] = {}
+        # languages with an n-gram gate only run the transformer on lines the n-gram table is unsure of
+        self.cascade_gates = cascade_gates or {}
+        self.answered = Counter()
+        self.profiler = profiler
+        # finished predictions keyed on (language, padded window, k); many lines share a window once truncated
+        self.cache = prediction_cache.PredictionCache(cache_size)
+        self.router = language_router.LanguageRouter()
+        if bundle is not None:
+            # every language comes out of one mapped file; no checkpoint unpickling or pytorch_lightning
+            weights = model_bundle.ModelBundle(bundle)
+            self.configs = bundle_configs(weights)
+            self.my_models = model_registry.ModelRegistry(
+                lambda lang: load_bundled(weights, lang, quantize=quantize, fuse=fuse), max_models=max_models,
+                max_bytes=max_bytes, warm_up=warm_up)
+        elif multilingual is not None:
+            # every language is a view onto one shared backbone, so there is nothing to evict
+            if max_models is not None or max_bytes is not None:
+                raise ValueError("a multilingual backbone is loaded whole; max_models and max_bytes do not apply")
+            backbone = load_multilingual(multilingual, self.configs, quantize=quantize, fuse=fuse)
+            self.my_models = model_registry.ModelRegistry(backbone.view, warm_up=warm_up)
+        else:
+            # checkpoints are loaded on first use and evicted least-recently-used past the caps
+            self.my_models = model_registry.ModelRegistry(
+                lambda lang: load_model(self.configs[lang], quantize=quantize, fuse=fuse), max_models=max_models,
+                max_bytes=max_bytes, warm_up=warm_up)
+        self.decoders: Dict[str, model.IncrementalDecoder] = {}
 
     @classmethod
     def load_test_data(cls, fname):
@@ -86,128 +221,355 @@ class MyModel:
             for p in preds:
                 f.write(f"{p}\n")
 
-    def prediction_from_line(self, line: str, k: int) -> str:
-        lang_class = classify(line)   # returns a tuple of language id and -log prob
-        config = self.configs[lang_class[0]]
+    def _window(self, line: str, config: MyModelConfig, padded: bool = True) -> str:
         if len(line) >= config.sequence_length:
-            line = line[-config.sequence_length:]
-        else:    
-            line = config.dummy_prompt[-(
-                config.sequence_length - len(line)):] + line
-        
-        model = self.my_models[lang_class[0]]
-        x = torch.ByteTensor([model.embed.indexer.to_index(symbol)
-                              for symbol in line]).unsqueeze(0)
-        y_pred = model(x).squeeze(0)[-1]
-        result = model.embed.interpret(y_pred, k=k+1)
-        result = [c for c in result if c is not None][:k]
-        return "" .join(result)
-
-    def run_pred(self, data: List[str]):
-        # your code here
-        preds: List[str] = []
-        for line in data:
-            preds.append(self.prediction_from_line(line, k=3))
-        return preds
+            return line[-config.sequence_length:]
+        if (self.padding == "none" or not padded) and line:
+            return line
+        return config.dummy_prompt[-(config.sequence_length - len(line)):] + line
+
+    def _pad_length(self, line: str, config: MyModelConfig) -> int:
+        # how many leading dummy-prompt symbols of the line's window come from a cached prefix instead of
+        # being run as tokens; early exit runs whole windows
+        if self.padding != "cached" or self.exit_threshold is not None:
+            return 0
+        if not 0 < len(line) < config.sequence_length:
+            return 0
+        return config.sequence_length - len(line)
+
+    def _prefix_cache(self, lang: str, language_model: model.BasicModel, pad: int) -> List[model.KVCache]:
+        # keys and values of the last `pad` dummy-prompt symbols at positions [0, pad), per language and
+        # pad length; dropped when the language's model is reloaded
+        entry = self.prefix_caches.get((lang, pad))
+        if entry is None or entry[0]() is not language_model:
+            x = torch.from_numpy(language_model.embed.indexer.encode(self.configs[lang].dummy_prompt[-pad:]))
+            with torch.inference_mode():
+                _, cache = language_model.forward_incremental(x.unsqueeze(0))
+            entry = (weakref.ref(language_model), cache)
+            self.prefix_caches[lang, pad] = entry
+        return entry[1]
+
+    def _last_logits(self, lang: str, language_model: model.BasicModel, x: torch.Tensor) -> torch.Tensor:
+        # logits at the last position of every window, [N, D]
+        if self.exit_threshold is None:
+            return language_model(x)[:, -1, :]
+        exit_model = self.exit_models.get(lang)
+        if exit_model is None or exit_model.function is not language_model:
+            # trained exit heads are used when they exist next to the weights, otherwise the shared head
+            path = early_exit.exit_heads_path(self.configs[lang].chkpt_path, lang)
+            heads = early_exit.load_exit_heads(language_model, path) if os.path.exists(path) else None
+            exit_model = early_exit.EarlyExitModel(language_model, self.exit_threshold, heads).eval()
+            if lang in self.exit_models:
+                exit_model.exits = self.exit_models[lang].exits
+            self.exit_models[lang] = exit_model
+        return exit_model(x)
+
+    def exit_stats(self) -> Dict[str, List[int]]:
+        # lines that stopped after each attention layer, per language
+        return {lang: [exit_model.exits[i] for i in range(len(exit_model.function.attention_layers()))]
+                for lang, exit_model in self.exit_models.items()}
+
+    def _language_model(self, lang: str) -> model.BasicModel:
+        with self.profiler.stage("load", lang):
+            language_model = self.my_models[lang]
+        self.profiler.attach(language_model)
+        return language_model
+
+    def prediction_from_line(self, line: str, k: int, incremental: bool = False) -> str:
+        with self.profiler.stage("route"):
+            lang = self.router.route(line)
+        config = self.configs[lang]
+        with self.profiler.stage("pad", lang):
+            window = self._window(line, config, padded=not incremental)
+        cached = self.cache.get((lang, window, k))
+        if cached is not None:
+            return cached
+        if lang in self.cascade_gates:
+            # the n-gram table reads the unpadded line, so short lines get its <start> context
+            with self.profiler.stage("ngram", lang):
+                (ngram_pred,), (confident,) = self.cascade_gates[lang].predict([line], k)
+            if confident:
+                self.answered['ngram'] += 1
+                self.cache.put((lang, window, k), ngram_pred)
+                return ngram_pred
+        self.answered['transformer'] += 1
+
+        if incremental and self.exit_threshold is None:
+            result = self._decode(lang, window, k)
+        else:
+            pad = 0 if incremental else self._pad_length(line, config)
+            result, = self.predict_windows(lang, [window], k, [pad])
+        self.cache.put((lang, window, k), result)
+        return result
+
+    def prediction_incremental(self, prompt: str, k: int) -> str:
+        # prompts shorter than the window run unpadded and left-aligned, as with --padding none, so each
+        # keystroke only runs its one new position on the decoder's cached keys and values. The price is
+        # that short prompts see no dummy-prompt context and can be answered differently than in test mode
+        # with cached or dummy padding; from sequence_length symbols on, the window slides and every
+        # keystroke runs the whole window, with the same answers as test mode
+        return self.prediction_from_line(prompt, k, incremental=True)
+
+    def _decode(self, lang: str, window: str, k: int) -> str:
+        language_model = self._language_model(lang)
+        decoder = self.decoders.get(lang)
+        if decoder is None or decoder.model is not language_model:
+            decoder = self.decoders[lang] = model.IncrementalDecoder(language_model)
+        with self.profiler.stage("forward", lang):
+            y_pred = decoder.decode(window)
+        result = language_model.embed.interpret(y_pred, k=k+1)
+        return "".join([c for c in result if c is not None][:k])
+
+    def predict_batch(self, lang: str, lines: List[str], k: int) -> List[str]:
+        config = self.configs[lang]
+        with self.profiler.stage("pad", lang):
+            windows = [self._window(line, config) for line in lines]
+        return self.predict_windows(lang, windows, k, [self._pad_length(line, config) for line in lines])
+
+    def predict_windows(self, lang: str, windows: List[str], k: int,
+                        pad_lengths: Optional[List[int]] = None) -> List[str]:
+        # windows are bucketed by (cached pad length, length); a bucket with a pad length only runs the
+        # symbols after the pad, on top of the dummy prompt's cached keys and values
+        model = self._language_model(lang)
+        buckets: Dict[Tuple[int, int], List[int]] = {}
+        for i, (window, pad) in enumerate(zip(windows, pad_lengths or [0] * len(windows))):
+            buckets.setdefault((pad, len(window)), []).append(i)
+
+        with torch.inference_mode():
+            y_pred = torch.empty(len(windows), model.embed.indexer.size())
+            for (pad, _), indices in buckets.items():
+                with self.profiler.stage("encode", lang):
+                    x = torch.from_numpy(model.embed.indexer.encode([windows[i][pad:] for i in indices]))
+                with self.profiler.stage("forward", lang):
+                    if pad:
+                        cache = [(keys.expand(len(indices), -1, -1, -1), values.expand(len(indices), -1, -1, -1))
+                                 for keys, values in self._prefix_cache(lang, model, pad)]
+                        y_pred[indices] = model.forward_incremental(x, cache, start=pad)[0][:, -1]
+                    else:
+                        y_pred[indices] = self._last_logits(lang, model, x)
+        with self.profiler.stage("topk", lang):
+            results = model.embed.interpret_batch(y_pred, k=k+1)
+            return ["".join([c for c in result if c is not None][:k]) for result in results]
+
+    def run_pred(self, data: List[str], batch_size: int = 256, langs: Optional[List[str]] = None):
+        # group lines by language so each model sees [batch_size, sequence_length] batches
+        if langs is None:
+            with self.profiler.stage("route"):
+                langs = [self.router.route(line) for line in data]
+        groups: Dict[str, List[int]] = {}
+        for i, lang in enumerate(langs):
+            groups.setdefault(lang, []).append(i)
+        keys: List[Tuple[str, str, int]] = [None] * len(data)
+        pads: Dict[int, int] = {}
+        for lang, indices in groups.items():
+            config = self.configs[lang]
+            with self.profiler.stage("pad", lang):
+                for i in indices:
+                    keys[i] = (lang, self._window(data[i], config), 3)
+                    pads[i] = self._pad_length(data[i], config)
+
+        # each distinct window is looked up once; only the cache misses reach the models
+        found: Dict[Tuple[str, str, int], str] = {}
+        missing: Dict[str, List[int]] = {}
+        for i, key in enumerate(keys):
+            if key in found:
+                continue
+            cached = self.cache.get(key)
+            if cached is None:
+                missing.setdefault(key[0], []).append(i)
+            found[key] = cached
+        self.cache.deduplicated(len(keys) - len(found))
+
+        for lang, indices in missing.items():
+            if lang in self.cascade_gates:
+                with self.profiler.stage("ngram", lang):
+                    ngram_preds, confident = self.cascade_gates[lang].predict([data[i] for i in indices])
+                for i, pred, sure in zip(indices, ngram_preds, confident):
+                    if sure:
+                        found[keys[i]] = pred
+                        self.cache.put(keys[i], pred)
+                indices = [i for i, sure in zip(indices, confident) if not sure]
+                self.answered['ngram'] += int(confident.sum())
+            self.answered['transformer'] += len(indices)
+            # neighbouring lines of equal length share a bucket inside predict_windows
+            indices = sorted(indices, key=lambda i: (pads[i], len(keys[i][1])))
+            for start in range(0, len(indices), batch_size):
+                chunk = indices[start:start + batch_size]
+                chunk_preds = self.predict_windows(lang, [keys[i][1] for i in chunk], 3, [pads[i] for i in chunk])
+                for i, pred in zip(chunk, chunk_preds):
+                    found[keys[i]] = pred
+                    self.cache.put(keys[i], pred)
+        return [found[key] for key in keys]
+
+    def run_pred_parallel(self, data: List[str], workers: int, batch_size: int = 256):
+        # route and load every needed model in the parent, then fork: the workers read the weights
+        # copy-on-write instead of each loading their own copy
+        langs = [self.router.route(line) for line in data]
+        # only the first line of every distinct (language, window) is sent to a worker
+        keys = [(lang, self._window(line, self.configs[lang]), 3) for line, lang in zip(data, langs)]
+        first = {}
+        for i, key in enumerate(keys):
+            first.setdefault(key, i)
+        self.cache.deduplicated(len(keys) - len(first))
+        preds = {key: self.cache.get(key) for key in first}
+        unique = [i for key, i in first.items() if preds[key] is None]
+        if not unique:
+            return [preds[key] for key in keys]
+        shard_size = -(-len(unique) // workers)
+        shards = [([data[i] for i in unique[j:j + shard_size]], [langs[i] for i in unique[j:j + shard_size]],
+                   batch_size) for j in range(0, len(unique), shard_size)]
+
+        # a model evicted before the fork would be loaded again by every worker, so all of them stay
+        # resident until the workers are done
+        with self.my_models.pinned(sorted({langs[i] for i in unique})):
+            if self.my_models.over_budget():
+                print("Keeping {} models loaded for the workers, over the --max_models/--max_model_bytes "
+                      "budget".format(len(self.my_models.resident())))
+            global _WORKER_MODEL
+            _WORKER_MODEL = self
+            threads = max(1, torch.get_num_threads() // workers)
+            with multiprocessing.get_context("fork").Pool(workers, initializer=torch.set_num_threads,
+                                                          initargs=(threads,)) as pool:
+                results = pool.map(_predict_shard, shards, chunksize=1)
+        for i, pred in zip(unique, (pred for shard in results for pred in shard)):
+            preds[keys[i]] = pred
+            self.cache.put(keys[i], pred)
+        return [preds[key] for key in keys]
+
+
+_WORKER_MODEL: Optional[MyModel] = None
+
+
+def _predict_shard(shard: Tuple[List[str], List[str], int]) -> List[str]:
+    data, langs, batch_size = shard
+    return _WORKER_MODEL.run_pred(data, batch_size=batch_size, langs=langs)
 
 
 if __name__ == "__main__":
     parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument("mode", choices=(
-        "train", "test", "interactive"), help="what to run")
+        "train", "test", "interactive", "serve"), help="what to run")
     parser.add_argument("--work_dir", help="where to save", default="work")
     parser.add_argument("--test_data", help="path to test data",
                         default="example/input.txt")
     parser.add_argument(
         "--test_output", help="path to write test predictions", default="pred.txt")
+    parser.add_argument("--batch_size", help="lines per forward pass in test mode",
+                        type=int, default=256)
+    parser.add_argument("--workers", help="processes to shard test mode across", type=int, default=1)
+    parser.add_argument("--max_models", help="most language models kept loaded at once",
+                        type=int, default=None)
+    parser.add_argument("--max_model_bytes", help="most parameter bytes kept loaded at once",
+                        type=int, default=None)
+    parser.add_argument("--host", help="address to serve on", default="127.0.0.1")
+    parser.add_argument("--port", help="port to serve on", type=int, default=8447)
+    parser.add_argument("--socket", help="serve on this Unix socket instead of TCP", default=None)
+    parser.add_argument("--max_wait_ms", help="how long serve mode waits to fill a micro-batch",
+                        type=float, default=5.0)
+    parser.add_argument("--cache_size", help="predictions remembered across calls (0 disables)",
+                        type=int, default=1 << 16)
+    parser.add_argument("--profile", help="print time, calls and allocations per prediction stage",
+                        action="store_true")
+    parser.add_argument("--profile_memory", help="also count Python allocations per stage (slower)",
+                        action="store_true")
+    parser.add_argument("--trace", help="write a Chrome trace of the prediction stages here", default=None)
+    parser.add_argument("--quantize", help="run int8 dynamically quantized models", action="store_true")
+    parser.add_argument("--fuse", help="fold the attention projections for inference", action="store_true")
+    parser.add_argument("--multilingual", help="checkpoint of a shared MultilingualModel to serve every language",
+                        default=None)
+    parser.add_argument("--bundle", help="load every language from this weights bundle instead of the "
+                        "checkpoints; without a path, <work_dir>/models.bundle", nargs="?", const="", default=None)
+    parser.add_argument("--ngram", help="n-gram models to answer confident lines before the transformer",
+                        nargs="*", default=[], metavar="LANG=PATH")
+    parser.add_argument("--cascade_gate", help="n-gram confidence measure", choices=("mass", "margin"),
+                        default="mass")
+    parser.add_argument("--cascade_threshold", help="n-gram confidence needed to skip the transformer "
+                        "(see cascade.py for calibrating it)", type=float, default=0.6)
+    parser.add_argument("--early_exit", help="stop after the first attention layer whose top-3 probability "
+                        "mass reaches this (see early_exit.py for exit heads and calibration)", type=float,
+                        default=None)
+    parser.add_argument("--padding", help="how lines shorter than the window are padded: cached dummy-prompt "
+                        "context, the dummy prompt run as tokens, or not at all", choices=("cached", "dummy", "none"),
+                        default="cached")
+    parser.add_argument("--warm_up", help="languages to load at startup", nargs="*",
+                        choices=sorted(CONFIGS), default=[])
     args = parser.parse_args()
-
-    CONFIG_ENGLISH = MyModelConfig(
-        chkpt_path="work/english.ckpt",
-        dummy_prompt="in other words, living an eternity of just about anything is now more terrifying to me than death. ",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_SPANISH = MyModelConfig(
-        chkpt_path="work/spanish.ckpt",
-        dummy_prompt="Tomebamba también conocido como Tumipampa fue el centro administrativo del norte del Imperio inca, antes de la conquista Inca era el asentamiento cañari de Guapondelig. ",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_RUSSIAN = MyModelConfig(
-        chkpt_path="work/russian.ckpt",
-        dummy_prompt="старейшее из существующих семейство с территории Южных Нидерландов, сначала баронское, затем княжеское. Упоминается на страницах источников с XII века. ",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_JAPANESE = MyModelConfig(
-        chkpt_path="work/japanese.ckpt",
-        dummy_prompt="ヒトにおいて19遺伝子存在するアルデヒドデヒドロゲナーゼ遺伝子の1つであり、コードしているALDH2タンパク質はヒトの肝臓を中心に様々な組織、細胞においてエタノールの代謝産物であるアセトアルデヒドを含む反応性アルデヒドの酸化および無毒化に重要な働きをしている酵素である",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_NORWEGIAN = MyModelConfig(
-        chkpt_path="work/norwegian.ckpt",
-        dummy_prompt="ar ikke noe sånn vondt ment det ei nlle skulle rette opp så du en feil så skulle n kke sant a det internt og for at det skulle være bra når det ga ja da syns vi var veldig e det er veldig e fornø",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_CHINESE = MyModelConfig(
-        chkpt_path="work/chinese.ckpt",
-        dummy_prompt="是一种较弱的雌性甾体性激素，是三种主要的内源性雌激素之一，另外两种为雌二醇和雌三醇。雌酮等雌激素的生物合成从膽固醇开始，大部分由生殖腺分泌，少部分为脂肪組織对来自腎上腺的雄激素的转化。相对于雌二醇而言，雌酮和雌三醇的活性都很小。雌酮可转化为雌二醇，是主要的雌二醇代謝前体。 孩童+青春期 出生1-14 天：新生兒的雌酮水平在出生時非常高，但會在幾天內降至青春期前水平。 男性 #青春期開始",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_HINDI = MyModelConfig(
-        chkpt_path="work/hindi.ckpt",
-        dummy_prompt="प्रतिशत तक क्षाराभ पाए जाते हैं जिनमें रिसरपिन प्रमुख हैं इसका गुण रूक्ष, रस में तिक्त, विपाक में कटु और इसका प्रभाव निद्राजनक होता है।",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
-
-    CONFIG_FRENCH = MyModelConfig(
-        chkpt_path="work/french.ckpt",
-        dummy_prompt="Cette géométrie change significativement lors de la chélation : Les éthers couronnes peuvent être utilisés au laboratoire comme catalyseurs de transfert de phase, bien qu'il existe de tels catalyseurs moins chers et moins spécifiques. En présence de 18-C-6, le permanganate de potassium se dissout dans le benzène en donnant du benzène violet",
-        device=DEVICE,
-        sequence_length=64,
-        embed_dim=192,
-    )
+    if (args.profile or args.profile_memory or args.trace) and args.workers > 1:
+        parser.error("profiling only covers the parent process; use --workers 1")
+    if args.bundle is not None and args.multilingual is not None:
+        parser.error("--bundle and --multilingual are different weights; pick one")
+    if args.multilingual is not None and (args.max_models is not None or args.max_model_bytes is not None):
+        parser.error("--multilingual loads one shared backbone; --max_models and --max_model_bytes do not apply")
+    if args.bundle == "":
+        args.bundle = str(model_bundle.bundle_path(args.work_dir))
+    if args.bundle is not None:
+        print("Loading models from {}".format(args.bundle))
+    cascade_gates = None
+    if args.ngram:
+        import cascade
+        cascade_gates = cascade.parse_gates(args.ngram, args.cascade_threshold, args.cascade_gate)
+    stage_profiler = profiling.NULL_PROFILER
+    if args.profile or args.profile_memory or args.trace:
+        stage_profiler = profiling.Profiler(trace=args.trace is not None, memory=args.profile_memory)
 
     if args.mode == "train":
         if not os.path.isdir(args.work_dir):
             print("Making working directory {}".format(args.work_dir))
             os.makedirs(args.work_dir)
     elif args.mode == "test":
-        set_languages(['en', 'es', 'ru', 'ja', 'no', 'zh', 'hi', 'fr'])
-        model = MyModel()
+        my_model = MyModel(max_models=args.max_models, max_bytes=args.max_model_bytes,
+                           warm_up=args.warm_up, quantize=args.quantize,
+                           fuse=args.fuse, multilingual=args.multilingual,
+                           profiler=stage_profiler, cache_size=args.cache_size, bundle=args.bundle,
+                           cascade_gates=cascade_gates, exit_threshold=args.early_exit,
+                           padding=args.padding)
         print("Loading test data from {}".format(args.test_data))
         test_data = MyModel.load_test_data(args.test_data)
         print("Making predictions")
-        pred = model.run_pred(test_data)
+        if args.workers > 1:
+            pred = my_model.run_pred_parallel(test_data, args.workers, batch_size=args.batch_size)
+        else:
+            pred = my_model.run_pred(test_data, batch_size=args.batch_size)
         print("Writing predictions to {}".format(args.test_output))
         assert len(pred) == len(test_data), "Expected {} predictions but got {}".format(
             len(test_data), len(pred))
-        model.write_pred(pred, args.test_output)
+        my_model.write_pred(pred, args.test_output)
+        print("Language routing: {}".format(my_model.router.stats()))
+        print("Model pool: {}".format(my_model.my_models.stats()))
+        print("Prediction cache: {}".format(my_model.cache.stats()))
+        if cascade_gates:
+            print("Answered by: {}".format(dict(my_model.answered)))
+        if args.early_exit is not None:
+            print("Exits per attention layer: {}".format(my_model.exit_stats()))
+        if stage_profiler.enabled:
+            print(stage_profiler.summary())
+        if args.trace is not None:
+            print("Writing trace to {}".format(args.trace))
+            stage_profiler.write_trace(args.trace)
     elif args.mode == "interactive":
-        set_languages(['en', 'es', 'ru', 'ja', 'no', 'zh', 'hi' ,'fr'])
-        model = MyModel()
+        my_model = MyModel(max_models=args.max_models, max_bytes=args.max_model_bytes,
+                           warm_up=args.warm_up, quantize=args.quantize,
+                           fuse=args.fuse, multilingual=args.multilingual,
+                           profiler=stage_profiler, cache_size=args.cache_size, bundle=args.bundle,
+                           cascade_gates=cascade_gates, exit_threshold=args.early_exit,
+                           padding=args.padding)
         user_prompt = ""
         while True:
-            print(model.prediction_from_line(user_prompt, k=3))
+            print(my_model.prediction_incremental(user_prompt, k=3))
             user_prompt += input(user_prompt)
+    elif args.mode == "serve":
+        import asyncio
+        import server
+
+        my_model = MyModel(max_models=args.max_models, max_bytes=args.max_model_bytes,
+                           warm_up=args.warm_up, quantize=args.quantize,
+                           fuse=args.fuse, multilingual=args.multilingual,
+                           profiler=stage_profiler, cache_size=args.cache_size, bundle=args.bundle,
+                           cascade_gates=cascade_gates, exit_threshold=args.early_exit,
+                           padding=args.padding)
+        prediction_server = server.PredictionServer(my_model, batch_size=args.batch_size,
+                                                    max_wait_ms=args.max_wait_ms)
+        asyncio.run(prediction_server.serve(args.host, args.port, args.socket))
 
     else:
         raise NotImplementedError("Unknown mode {}".format(args.mode))
@@ -1,6 +1,12 @@
 import heapq
 from math import log
 
+import numpy as np
+
+import array_bundle
+import data_util
+import train_helper
+
 def pred(N, char_count, unknown_chars, vocab, bigram_sum, bigram_count, trigram_sum, trigram_count, lambdas, tok_1, tok_2):
     l_1, l_2, l_3 = lambdas[0], lambdas[1], lambdas[2]
     min_heap = []
@@ -38,3 +44,214 @@ def pred(N, char_count, unknown_chars, vocab, bigram_sum, bigram_count, trigram_
         if elem[1] != '<unk>' and elem[1] != ' ' :
             result.append(elem[1])
     return ''.join(result)
+
+
+SPECIAL_TOKENS = ('<start>', '<unk>', '<stop>')
+SKIPPED_TOKENS = ('<unk>', ' ')
+
+
+def split_context(base_str):
+    # inverse of tok_1 + tok_2 for single-symbol and special tokens
+    for tok_1 in SPECIAL_TOKENS + (base_str[:1],):
+        tok_2 = base_str[len(tok_1):]
+        if base_str.startswith(tok_1) and (len(tok_2) == 1 or tok_2 in SPECIAL_TOKENS):
+            return tok_1, tok_2
+    raise ValueError("cannot split context {!r}".format(base_str))
+
+
+class TopKTable:
+    # top-k completions and their interpolated probabilities for every observed (tok_1, tok_2)
+    # context, with bigram (tok_2 only) and unigram fallbacks; contexts are packed as tok_1 * V + tok_2
+    def __init__(self, vocab, trigram_keys, trigram_ids, trigram_probs, bigram_keys, bigram_ids, bigram_probs,
+                 unigram_ids, unigram_probs):
+        self.vocab = vocab
+        self.token_ids = {token: i for i, token in enumerate(vocab)}
+        self.trigram_keys, self.trigram_ids, self.trigram_probs = trigram_keys, trigram_ids, trigram_probs
+        self.bigram_keys, self.bigram_ids, self.bigram_probs = bigram_keys, bigram_ids, bigram_probs
+        self.unigram_ids, self.unigram_probs = unigram_ids, unigram_probs
+
+    @property
+    def k(self):
+        return self.unigram_ids.shape[0]
+
+    def to_arrays(self):
+        vocab_blob, vocab_offsets = array_bundle.strings_to_arrays(self.vocab)
+        return {"vocab": vocab_blob, "vocab_offsets": vocab_offsets,
+                "trigram_keys": self.trigram_keys, "trigram_ids": self.trigram_ids, "trigram_probs": self.trigram_probs,
+                "bigram_keys": self.bigram_keys, "bigram_ids": self.bigram_ids, "bigram_probs": self.bigram_probs,
+                "unigram_ids": self.unigram_ids, "unigram_probs": self.unigram_probs}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        vocab = array_bundle.arrays_to_strings(arrays["vocab"], arrays["vocab_offsets"])
+        return cls(vocab, arrays["trigram_keys"], arrays["trigram_ids"], arrays["trigram_probs"],
+                   arrays["bigram_keys"], arrays["bigram_ids"], arrays["bigram_probs"],
+                   arrays["unigram_ids"], arrays["unigram_probs"])
+
+    def lookup_ids(self, tok_1s, tok_2s):
+        V = len(self.vocab)
+        id_1 = np.array([self.token_ids.get(tok, -1) for tok in tok_1s], dtype=np.int64)
+        id_2 = np.array([self.token_ids.get(tok, -1) for tok in tok_2s], dtype=np.int64)
+
+        ids = np.broadcast_to(self.unigram_ids, (len(id_1), self.k)).copy()
+        probs = np.broadcast_to(self.unigram_probs, (len(id_1), self.k)).copy()
+        for keys, table_ids, table_probs, query in (
+                (self.bigram_keys, self.bigram_ids, self.bigram_probs, np.where(id_2 >= 0, id_2, -1)),
+                (self.trigram_keys, self.trigram_ids, self.trigram_probs,
+                 np.where((id_1 >= 0) & (id_2 >= 0), id_1 * V + id_2, -1))):
+            if len(keys) == 0:
+                continue
+            pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+            found = keys[pos] == query
+            ids[found] = table_ids[pos[found]]
+            probs[found] = table_probs[pos[found]]
+        return ids, probs
+
+    def lookup_batch(self, contexts):
+        ids, probs = self.lookup_ids([tok_1 for tok_1, _ in contexts], [tok_2 for _, tok_2 in contexts])
+        return ["".join(self.vocab[i] for i in row) for row in ids.tolist()], probs
+
+    def lookup(self, tok_1, tok_2):
+        results, _ = self.lookup_batch([(tok_1, tok_2)])
+        return results[0]
+
+
+def compile_topk(N, char_count, unknown_chars, vocab, bigram_sum, bigram_count, trigram_sum, trigram_count,
+                 lambdas, k=3):
+    l_1, l_2, l_3 = lambdas[0], lambdas[1], lambdas[2]
+    tokens = sorted({'<unk>' if token in unknown_chars else token for token in vocab})
+    unigram = {token: l_1 * char_count[token]/N for token in tokens}
+    unigram_total = sum(unigram.values())
+    candidates = [token for token in tokens if token not in SKIPPED_TOKENS]
+    # tokens never seen after a context keep their unigram order, so only the first few can make the top k
+    by_unigram = sorted(candidates, key=lambda token: (-log(unigram[token], 2), token))
+    candidate_set = set(candidates)
+
+    def best(bi_map, bi_denom, tri_map, tri_denom):
+        observed = [token for token in set(bi_map) | set(tri_map) if token in candidate_set]
+        scores = {}
+        for token in observed + by_unigram[:k + len(observed)]:
+            bi_num = bi_map.get(token, 0)
+            bigram_prob = l_2 * (bi_num/bi_denom) if bi_num != 0 else 0
+            tri_num = tri_map.get(token, 0)
+            trigram_prob = l_3 * (tri_num/tri_denom) if tri_num != 0 else 0
+            scores[token] = unigram[token] + bigram_prob + trigram_prob
+        top = sorted(scores, key=lambda token: (-log(scores[token], 2), token))[:k]
+
+        total = unigram_total
+        total += sum(l_2 * bi_map[token]/bi_denom for token in bi_map if token in unigram)
+        total += sum(l_3 * tri_map[token]/tri_denom for token in tri_map if token in unigram)
+        return top, [scores[token] / total for token in top]
+
+    table_vocab = sorted(set(tokens) | set(SPECIAL_TOKENS) | set(bigram_count)
+                         | {tok for base_str in trigram_count for tok in split_context(base_str)})
+    token_ids = {token: i for i, token in enumerate(table_vocab)}
+
+    def build(rows):
+        rows = sorted(rows)
+        keys = np.array([key for key, _, _ in rows], dtype=np.int64)
+        ids = np.zeros((len(rows), k), dtype=np.int32)
+        probs = np.zeros((len(rows), k), dtype=np.float32)
+        for row, (_, top, top_probs) in enumerate(rows):
+            ids[row, :len(top)] = [token_ids[token] for token in top]
+            probs[row, :len(top)] = top_probs
+        return keys, ids, probs
+
+    bigram_rows = []
+    for tok_2, bi_map in bigram_count.items():
+        bigram_rows.append((token_ids[tok_2],) + best(bi_map, bigram_sum[tok_2], {}, 0))
+
+    trigram_rows = []
+    for base_str, tri_map in trigram_count.items():
+        tok_1, tok_2 = split_context(base_str)
+        bi_map = bigram_count.get(tok_2, {})
+        top, top_probs = best(bi_map, bigram_sum.get(tok_2, 0), tri_map, trigram_sum[base_str])
+        trigram_rows.append((token_ids[tok_1] * len(table_vocab) + token_ids[tok_2], top, top_probs))
+
+    (unigram_ids,), (unigram_probs,) = build([(0,) + best({}, 0, {}, 0)])[1:]
+    return TopKTable(table_vocab, *build(trigram_rows), *build(bigram_rows), unigram_ids, unigram_probs)
+
+
+def line_contexts(lines, unknown_chars):
+    contexts = []
+    for line in lines:
+        tok_1, tok_2 = (['<start>', '<start>'] + list(line[-2:]))[-2:]
+        contexts.append(('<unk>' if tok_1 in unknown_chars else tok_1, '<unk>' if tok_2 in unknown_chars else tok_2))
+    return contexts
+
+
+def pred_lines(table, lines, unknown_chars):
+    results, _ = table.lookup_batch(line_contexts(lines, unknown_chars))
+    return results
+
+
+NGRAM_FORMAT = "ngram-topk"
+NGRAM_FORMAT_VERSION = 1
+
+
+def save_model(path, table, unknown_chars, lambdas, counts=()):
+    # counts: train_helper.NGramCounts kept next to the table, e.g. for recompiling with other lambdas
+    unknown_blob, unknown_offsets = array_bundle.strings_to_arrays(sorted(unknown_chars))
+    arrays = dict(table.to_arrays(), unknown_chars=unknown_blob, unknown_chars_offsets=unknown_offsets)
+    for ngram_counts in counts:
+        arrays.update(ngram_counts.to_arrays("counts{}/".format(ngram_counts.n)))
+    meta = {"format": NGRAM_FORMAT, "version": NGRAM_FORMAT_VERSION, "k": table.k, "lambdas": list(lambdas),
+            "counts": [ngram_counts.n for ngram_counts in counts]}
+    array_bundle.write_bundle(path, arrays, meta)
+
+
+def load_model(path):
+    meta, arrays = array_bundle.read_bundle(path)
+    if meta.get("format") != NGRAM_FORMAT or meta.get("version") != NGRAM_FORMAT_VERSION:
+        raise ValueError("{} is not a version {} {} file".format(path, NGRAM_FORMAT_VERSION, NGRAM_FORMAT))
+    unknown_chars = set(array_bundle.arrays_to_strings(arrays["unknown_chars"], arrays["unknown_chars_offsets"]))
+    counts = {n: train_helper.NGramCounts.from_arrays(n, arrays, "counts{}/".format(n)) for n in meta["counts"]}
+    return TopKTable.from_arrays(arrays), unknown_chars, counts
+
+
+def read_lines(train_path):
+    with data_util.open_text(train_path) as train_data:
+        for line in train_data:
+            yield line.rstrip("\n")
+
+
+def build_model(train_path, lambdas, k=3, workers=None):
+    # two streaming passes: the unknown symbols have to be known before the n-grams are counted, and the
+    # bigrams come out of the trigram counts
+    N, char_count, unknown_chars = train_helper.unigram(read_lines(train_path))
+    trigram_counts = train_helper.ngram(read_lines(train_path), unknown_chars, 3, workers=workers)
+    bigram_counts = trigram_counts.lower()
+    bigram_sum, bigram_count = bigram_counts.to_dicts()
+    trigram_sum, trigram_count = trigram_counts.to_dicts()
+    table = compile_topk(N, char_count, unknown_chars, list(char_count), bigram_sum, bigram_count,
+                         trigram_sum, trigram_count, lambdas, k=k)
+    return table, unknown_chars, [bigram_counts, trigram_counts]
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+    build_parser = subparsers.add_parser("build", help="count a training file and write a binary model")
+    build_parser.add_argument("train_data")
+    build_parser.add_argument("model_path")
+    build_parser.add_argument("--lambdas", type=float, nargs=3, default=[0.1, 0.3, 0.6])
+    build_parser.add_argument("--k", type=int, default=3)
+    build_parser.add_argument("--workers", type=int, default=None)
+    test_parser = subparsers.add_parser("test", help="predict every line of a test file")
+    test_parser.add_argument("model_path")
+    test_parser.add_argument("test_data")
+    test_parser.add_argument("test_output")
+    args = parser.parse_args()
+
+    if args.mode == "build":
+        table, unknown_chars, counts = build_model(args.train_data, args.lambdas, k=args.k, workers=args.workers)
+        save_model(args.model_path, table, unknown_chars, args.lambdas, counts)
+    else:
+        table, unknown_chars, _ = load_model(args.model_path)
+        with open(args.test_data) as f:
+            data = [line[:-1].lower() for line in f]
+        with open(args.test_output, "wt") as f:
+            for p in pred_lines(table, data, unknown_chars):
+                f.write(f"{p}\n")
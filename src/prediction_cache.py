@@ -0,0 +1,37 @@
+from collections import Counter, OrderedDict
+from typing import Dict, Hashable, Optional
+
+
+class PredictionCache:
+    # bounded LRU of finished predictions; a max_size of 0 keeps nothing between calls
+    def __init__(self, max_size: int = 1 << 16):
+        self.max_size = max_size
+        self.counts = Counter()
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        value = self._entries.get(key)
+        if value is None:
+            self.counts['misses'] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.counts['hits'] += 1
+        return value
+
+    def put(self, key: Hashable, value: str):
+        if self.max_size <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def deduplicated(self, count: int):
+        # lines answered by an identical window earlier in the same batch
+        self.counts['deduplicated'] += count
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.counts['hits'] + self.counts['misses'] + self.counts['deduplicated']
+        return {"size": len(self._entries), "hits": self.counts['hits'], "misses": self.counts['misses'],
+                "deduplicated": self.counts['deduplicated'],
+                "hit_rate": (self.counts['hits'] + self.counts['deduplicated']) / lookups if lookups else 0.0}
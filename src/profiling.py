@@ -0,0 +1,118 @@
+import contextlib
+import json
+import os
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import torch.nn as nn
+
+
+class NullProfiler:
+    # what MyModel uses when profiling is off: one shared no-op context, no clock reads
+    enabled = False
+    _null = contextlib.nullcontext()
+
+    def stage(self, name: str, lang: Optional[str] = None):
+        return self._null
+
+    def attach(self, function: nn.Module):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class Profiler(NullProfiler):
+    enabled = True
+
+    def __init__(self, trace: bool = False, memory: bool = False):
+        self.seconds: Dict[Tuple[str, Optional[str]], float] = defaultdict(float)
+        self.calls: Dict[Tuple[str, Optional[str]], int] = defaultdict(int)
+        self.allocated: Dict[Tuple[str, Optional[str]], int] = defaultdict(int)
+        self.events: Optional[List[Dict[str, object]]] = [] if trace else None
+        self.memory = memory
+        self._origin = time.perf_counter()
+        self._lang: Optional[str] = None
+        self._attached = weakref.WeakSet()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _record(self, name: str, lang: Optional[str], start: float, end: float, allocated: int = 0):
+        key = (name, lang)
+        self.seconds[key] += end - start
+        self.calls[key] += 1
+        self.allocated[key] += allocated
+        if self.events is not None:
+            self.events.append({"name": name, "cat": lang or "all", "ph": "X", "pid": os.getpid(),
+                                "tid": threading.get_ident(), "ts": 1e6 * (start - self._origin),
+                                "dur": 1e6 * (end - start), "args": {"lang": lang}})
+
+    @contextlib.contextmanager
+    def stage(self, name: str, lang: Optional[str] = None):
+        # allocations are net Python-heap bytes seen by tracemalloc; tensor storage is not counted
+        before = tracemalloc.get_traced_memory()[0] if self.memory else 0
+        outer_lang, self._lang = self._lang, lang
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._lang = outer_lang
+            allocated = tracemalloc.get_traced_memory()[0] - before if self.memory else 0
+            self._record(name, lang, start, end, allocated)
+
+    def attach(self, function: nn.Module):
+        # times every attention layer of the model as its own stage, under the language of the enclosing
+        # stage; layers shared between languages (MultilingualModel views) are only hooked once
+        for i, layer in enumerate(function.attention_layers()):
+            if layer in self._attached:
+                continue
+            self._attached.add(layer)
+            name = "attention_{}".format(i)
+            starts = []
+            layer.register_forward_pre_hook(lambda module, inputs, starts=starts: starts.append(time.perf_counter()))
+            layer.register_forward_hook(
+                lambda module, inputs, output, name=name, starts=starts:
+                self._record(name, self._lang, starts.pop(), time.perf_counter()))
+            # the cached-padding and incremental paths call forward_incremental directly, past the hooks;
+            # fused layers' forward also goes through it, and is only timed once
+            layer.forward_incremental = self._timed(layer.forward_incremental, name, starts)
+
+    def _timed(self, forward_incremental, name: str, starts: List[float]):
+        def timed(*args, **kwargs):
+            if starts:
+                return forward_incremental(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return forward_incremental(*args, **kwargs)
+            finally:
+                self._record(name, self._lang, start, time.perf_counter())
+        return timed
+
+    def summary(self) -> str:
+        # one total row per stage, slowest stage first, followed by its per-language rows
+        stages = sorted({name for name, _ in self.seconds},
+                        key=lambda name: -sum(seconds for (n, _), seconds in self.seconds.items() if n == name))
+        rows = [("stage", "lang", "calls", "total ms", "ms/call", "alloc KB")]
+        for name in stages:
+            keys = sorted((key for key in self.seconds if key[0] == name), key=lambda key: key[1] or "")
+            groups = [("all", keys)] + ([(key[1], [key]) for key in keys] if len(keys) > 1 or keys[0][1] else [])
+            for lang, group in groups:
+                seconds = sum(self.seconds[key] for key in group)
+                calls = sum(self.calls[key] for key in group)
+                allocated = sum(self.allocated[key] for key in group)
+                rows.append((name if lang == "all" else "", lang, str(calls), "{:.2f}".format(1000 * seconds),
+                             "{:.3f}".format(1000 * seconds / calls),
+                             "{:.1f}".format(allocated / 1024) if self.memory else "-"))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(cell.ljust(width) if i < 2 else cell.rjust(width)
+                                   for i, (cell, width) in enumerate(zip(row, widths))) for row in rows)
+
+    def write_trace(self, path: str):
+        # Chrome trace event format; open it in chrome://tracing or Perfetto
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.events or [], "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,115 @@
+import json
+import os
+import statistics
+import time
+from pathlib import Path
+from typing import Dict, Tuple
+
+import torch
+import torch.nn as nn
+
+import data_util
+import model
+
+
+def quantize_dynamic(function: model.BasicModel) -> model.BasicModel:
+    # int8 weights for every nn.Linear; the MultiheadAttention in/out projections stay fp32
+    return torch.quantization.quantize_dynamic(function, {nn.Linear}, dtype=torch.qint8)
+
+
+def quantized_path(chkpt_path: str) -> str:
+    return os.path.splitext(chkpt_path)[0] + ".int8.pt"
+
+
+def save_quantized(function: model.BasicModel, path: str):
+    torch.save(function.state_dict(), path)
+
+
+def load_quantized(length: int, indexer: data_util.SymbolIndexer, dim: int, path: str,
+                   device: str = "cpu") -> model.BasicModel:
+    function = quantize_dynamic(model.BasicModel(length, indexer, dim).eval())
+    function.load_state_dict(torch.load(path, map_location=device))
+    return function
+
+
+def heldout_windows(path: Path, indexer: data_util.SymbolIndexer, length: int, limit: int,
+                    stride: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    # (windows, symbol following each window) taken every `stride` symbols of the file
+    with open(path) as f:
+        tokens = torch.from_numpy(indexer.encode(f.read())).long()
+    starts = torch.arange(0, max(len(tokens) - length, 0), stride)[:limit]
+    windows = tokens[starts.unsqueeze(1) + torch.arange(length)]
+    return windows, tokens[starts + length]
+
+
+def measure(function: model.BasicModel, windows: torch.Tensor, targets: torch.Tensor, k: int,
+            batch_size: int, latency_samples: int) -> Dict[str, float]:
+    hits = 0
+    with torch.inference_mode():
+        start = time.perf_counter()
+        for i in range(0, len(windows), batch_size):
+            logits = function(windows[i:i + batch_size])[:, -1, :]
+            top = torch.topk(logits, k, dim=-1).indices
+            hits += (top == targets[i:i + batch_size].unsqueeze(1)).any(dim=1).sum().item()
+        batch_seconds = time.perf_counter() - start
+
+        latencies = []
+        for window in windows[:latency_samples]:
+            start = time.perf_counter()
+            function(window.unsqueeze(0))
+            latencies.append(time.perf_counter() - start)
+
+    return {"top{}_accuracy".format(k): hits / max(len(windows), 1),
+            "batched_ms_per_line": 1000 * batch_seconds / max(len(windows), 1),
+            "single_line_p50_ms": 1000 * statistics.median(latencies) if latencies else 0.0}
+
+
+def report(function: model.BasicModel, data_path: Path, k: int = 3, limit: int = 8192, stride: int = 61,
+           batch_size: int = 256, latency_samples: int = 200) -> Dict[str, object]:
+    # {"fp32": measurements, "int8": measurements, "lines": held-out windows measured}
+    function = function.eval()
+    indexer = function.embed.indexer
+    windows, targets = heldout_windows(data_path, indexer, function.pe.pe.size(1), limit, stride)
+    return {"fp32": measure(function, windows, targets, k, batch_size, latency_samples),
+            "int8": measure(quantize_dynamic(function), windows, targets, k, batch_size, latency_samples),
+            "lines": len(windows)}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+    import myprogram
+
+    parser = ArgumentParser(formatter_class=ArgumentDefaultsHelpFormatter)
+    parser.add_argument("mode", choices=("export", "report"),
+                        help="write int8 artifacts next to the checkpoints, or compare int8 against fp32")
+    parser.add_argument("--langs", nargs="*", choices=sorted(myprogram.CONFIGS), default=sorted(myprogram.CONFIGS))
+    parser.add_argument("--data", nargs="*", default=[],
+                        help="held-out file per language for report, in the same order as --langs")
+    parser.add_argument("--limit", type=int, default=8192, help="most held-out windows per language")
+    parser.add_argument("--output", default=None, help="also write the report as JSON")
+    args = parser.parse_args()
+    if args.mode == "report" and len(args.data) != len(args.langs):
+        parser.error("report needs one --data file per language: got {} for {} languages ({})".format(
+            len(args.data), len(args.langs), " ".join(args.langs)))
+
+    results = {}
+    for i, lang in enumerate(args.langs):
+        config = myprogram.CONFIGS[lang]
+        function = myprogram.load_model(config)
+        if args.mode == "export":
+            path = quantized_path(config.chkpt_path)
+            print("Writing {}".format(path))
+            save_quantized(quantize_dynamic(function.eval()), path)
+            continue
+
+        results[lang] = report(function, Path(args.data[i]), limit=args.limit)
+        fp32, int8 = results[lang]["fp32"], results[lang]["int8"]
+        print("{}: {} windows, top-3 {:.4f} -> {:.4f}, batched {:.3f} -> {:.3f} ms/line, "
+              "single line {:.2f} -> {:.2f} ms".format(
+                  lang, results[lang]["lines"], fp32["top3_accuracy"], int8["top3_accuracy"],
+                  fp32["batched_ms_per_line"], int8["batched_ms_per_line"],
+                  fp32["single_line_p50_ms"], int8["single_line_p50_ms"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import math
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(q * len(values)) - 1)]
+
+
+class PredictionServer:
+    # coalesces concurrent requests into one run_pred call; run_pred then splits the lines into
+    # per-language micro-batches
+    def __init__(self, my_model, batch_size: int = 256, max_wait_ms: float = 5.0, latency_window: int = 10000):
+        self.my_model = my_model
+        self.batch_size = batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.lines = 0
+        self.batches = 0
+        self.queue: Optional[asyncio.Queue] = None
+        # a single inference thread keeps the event loop free without running models concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def predict(self, lines: List[str]) -> List[str]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self.queue.put((lines, future, loop.time()))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[List[str], asyncio.Future, float]]:
+        loop = asyncio.get_running_loop()
+        requests = [await self.queue.get()]
+        count = len(requests[0][0])
+        deadline = loop.time() + self.max_wait
+        while count < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            requests.append(request)
+            count += len(request[0])
+        return requests
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = await self._next_batch()
+            lines = [line for request_lines, _, _ in requests for line in request_lines]
+            try:
+                preds = await loop.run_in_executor(self._executor, self.my_model.run_pred, lines, self.batch_size)
+            except Exception as e:
+                for _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            offset = 0
+            for request_lines, future, start in requests:
+                # the future is already cancelled when its client went away
+                if not future.done():
+                    future.set_result(preds[offset:offset + len(request_lines)])
+                offset += len(request_lines)
+                self.latencies.append(loop.time() - start)
+                self.requests += 1
+                self.lines += len(request_lines)
+
+    def stats(self) -> Dict[str, object]:
+        latencies = list(self.latencies)
+        return {"requests": self.requests, "lines": self.lines, "batches": self.batches,
+                "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "p50_ms": 1000 * percentile(latencies, 0.5), "p99_ms": 1000 * percentile(latencies, 0.99),
+                "cache": self.my_model.cache.stats()}
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: str, body: bytes, content_type: str):
+        writer.write("HTTP/1.1 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n".format(
+            status, content_type, len(body)).encode("ascii") + body)
+        await writer.drain()
+        writer.close()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # POST /predict takes one input per line and answers one prediction per line; GET /stats reports
+        # request latency percentiles and queue depth as JSON
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            if len(request_line) != 3:
+                raise ValueError("malformed request line")
+            method, path, _ = request_line
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get("content-length", "0")
+            if not length.isdigit():
+                raise ValueError("malformed Content-Length {!r}".format(length))
+            body = await reader.readexactly(int(length))
+            # UnicodeDecodeError is a ValueError, so bodies that are not UTF-8 get a 400 as well
+            text = body.decode("utf-8")
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            await self._respond(writer, "400 Bad Request", "{}\n".format(e).encode("utf-8"),
+                                "text/plain; charset=utf-8")
+            return
+
+        if method == "GET" and path == "/stats":
+            await self._respond(writer, "200 OK", json.dumps(self.stats()).encode("utf-8"), "application/json")
+        elif method == "POST" and path == "/predict":
+            lines = [line.lower() for line in text.split("\n")]
+            if lines and lines[-1] == "":
+                lines.pop()
+            try:
+                preds = await self.predict(lines)
+            except Exception as e:
+                await self._respond(writer, "500 Internal Server Error", "{}: {}\n".format(type(e).__name__, e)
+                                    .encode("utf-8"), "text/plain; charset=utf-8")
+                return
+            await self._respond(writer, "200 OK", "".join(f"{p}\n" for p in preds).encode("utf-8"),
+                                "text/plain; charset=utf-8")
+        else:
+            await self._respond(writer, "404 Not Found", b"", "text/plain")
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8447, unix_socket: Optional[str] = None):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self._batcher())
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        print("Serving on {}".format(unix_socket or "http://{}:{}".format(host, port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
@@ -0,0 +1,56 @@
+import random
+
+import pytest
+import torch
+
+import model
+import model_registry
+import myprogram
+
+
+def make_model(padding: str) -> myprogram.MyModel:
+    torch.manual_seed(0)
+    config = myprogram.CONFIGS["en"]
+    function = model.BasicModel(config.sequence_length, config.indexer(), 48).eval()
+    my_model = myprogram.MyModel(cache_size=0, padding=padding)
+    my_model.my_models = model_registry.ModelRegistry(lambda lang: function)
+    my_model.router.route = lambda line: "en"
+    return my_model
+
+
+def typed(steps: int = 150):
+    # one symbol at a time, well past the window length, with a backspace along the way
+    rng = random.Random(0)
+    prompt = ""
+    for step in range(steps):
+        prompt = prompt[:-1] if step == 70 else prompt + rng.choice("abcdefghij klmnop.,")
+        yield step, prompt
+
+
+@pytest.mark.parametrize("padding", ["cached", "dummy", "none"])
+def test_incremental_matches_full_window(padding):
+    # short prompts run unpadded in interactive mode whatever the padding, so they match --padding none;
+    # full windows match test mode in every padding mode
+    incremental, unpadded, padded = make_model(padding), make_model("none"), make_model(padding)
+    for _, prompt in typed():
+        expected = padded if len(prompt) >= 64 else unpadded
+        assert incremental.prediction_incremental(prompt, k=3) == expected.prediction_from_line(prompt, k=3), prompt
+
+
+def test_incremental_runs_one_position_per_keystroke():
+    my_model = make_model("cached")
+    function = my_model.my_models["en"]
+    positions = []
+    forward_incremental = function.forward_incremental
+
+    def counted(x, *args, **kwargs):
+        positions.append(x.size(1))
+        return forward_incremental(x, *args, **kwargs)
+
+    function.forward_incremental = counted
+    for step, prompt in typed():
+        positions.clear()
+        my_model.prediction_incremental(prompt, k=3)
+        # the keystroke that fills the window still extends it; after that, and after the backspace, the
+        # window slides and runs whole
+        assert positions == ([64] if step == 70 or len(prompt) > 64 else [1]), prompt
@@ -1,21 +1,221 @@
-from matplotlib.pyplot import text
+import hashlib
+import os
 import torch
+import numpy as np
 import data_util
 from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+
+def corpus_hash(path: Path, chunk_size: int = 1 << 24) -> str:
+    # hashing a multi-GB corpus is slow, so the digest is remembered per (size, mtime) in a sidecar file
+    stat = os.stat(path)
+    sidecar = path.parent / ".{}.{}-{}.hash".format(path.name, stat.st_size, stat.st_mtime_ns)
+    if sidecar.exists():
+        return sidecar.read_text().strip()
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(chunk_size), b""):
+            digest.update(chunk)
+    try:
+        sidecar.write_text(digest.hexdigest())
+    except OSError:
+        pass
+    return digest.hexdigest()
+
+
+def encode_corpus(path: Path, indexer: data_util.SymbolIndexer, cache_dir: Optional[Path] = None,
+                  chunk_size: int = 1 << 24) -> Path:
+    path = Path(path)
+    cache_dir = Path(cache_dir) if cache_dir is not None else path.parent / ".cache"
+    encoded = cache_dir / "{}-{}.{}.bin".format(corpus_hash(path), indexer.fingerprint(), indexer.dtype.name)
+    if encoded.exists():
+        return encoded
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    partial = encoded.with_suffix(".{}.tmp".format(os.getpid()))
+    with open(path) as src, open(partial, "wb") as dst:
+        for chunk in iter(lambda: src.read(chunk_size), ""):
+            dst.write(indexer.encode(chunk).tobytes())
+    os.replace(partial, encoded)
+    return encoded
+
+
+def open_encoded(path: Path, dtype: np.dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=dtype)
+    # copy-on-write keeps slices writable for torch.from_numpy while every worker shares the page cache
+    return np.memmap(path, dtype=dtype, mode="c")
 
 
 class TextDataset(torch.utils.data.Dataset):
-    def __init__(self, sequence_length: int, path: Path, indexer: data_util.SymbolIndexer):
+    def __init__(self, sequence_length: int, path: Path, indexer: data_util.SymbolIndexer,
+                 cache_dir: Optional[Path] = None):
         super().__init__()
         self.sequence_length = sequence_length
         self.indexer = indexer
-        with open(path) as text_data:
-            self.data = text_data.read()
+        self.encoded_path = encode_corpus(path, indexer, cache_dir)
+        self.data = open_encoded(self.encoded_path, indexer.dtype)
+
+    def __getstate__(self):
+        # spawned DataLoader workers re-map the file instead of receiving a pickled copy
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = open_encoded(self.encoded_path, self.indexer.dtype)
 
     def __len__(self) -> int:
         return len(self.data) - self.sequence_length + 1
 
-    def __getitem__(self, idx: int) -> torch.ByteTensor:
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        if idx >= len(self):
+            raise IndexError
+        return torch.from_numpy(self.data[idx:idx + self.sequence_length])
+
+
+class MultilingualDataset(torch.utils.data.Dataset):
+    # concatenation of per-language datasets whose items are (language index, window)
+    def __init__(self, datasets: Dict[str, TextDataset], languages: List[str]):
+        super().__init__()
+        self.languages = languages
+        self.datasets = [datasets[lang] for lang in languages]
+        self.offsets = np.cumsum([0] + [len(dataset) for dataset in self.datasets])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx: int):
         if idx >= len(self):
             raise IndexError
-        return torch.ByteTensor([self.indexer.to_index(s) for s in self.data[idx:idx + self.sequence_length]])
+        lang = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return torch.tensor(lang), self.datasets[lang][idx - int(self.offsets[lang])]
+
+
+class LanguageBatchSampler(torch.utils.data.Sampler):
+    # batches never mix languages, so each step runs a single embedding and output head
+    def __init__(self, dataset: MultilingualDataset, batch_size: int, shuffle: bool = True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = []
+        for lang, dataset in enumerate(self.dataset.datasets):
+            order = torch.randperm(len(dataset)) if self.shuffle else torch.arange(len(dataset))
+            order += int(self.dataset.offsets[lang])
+            batches.extend(order.split(self.batch_size))
+        for i in (torch.randperm(len(batches)) if self.shuffle else range(len(batches))):
+            yield batches[i].tolist()
+
+    def __len__(self) -> int:
+        return sum((len(dataset) + self.batch_size - 1) // self.batch_size for dataset in self.dataset.datasets)
+
+
+class StreamingTextDataset(torch.utils.data.IterableDataset):
+    # windows from any number of (optionally .gz/.bz2/.xz) text files, read chunk by chunk and never held
+    # in memory as a whole. DataLoader workers (and ranks) split the files between them by size, or every
+    # file's chunks when there are fewer files than workers. Windows go through a fixed [buffer_size, sequence_length] shuffle
+    # buffer and come out as [batch_size, sequence_length] batches (use DataLoader(batch_size=None)).
+    # Windows never cross a file boundary, as with one TextDataset per file.
+    def __init__(self, sequence_length: int, paths: Sequence[Path], indexer: data_util.SymbolIndexer,
+                 batch_size: int = 128, buffer_size: int = 1 << 16, chunk_size: int = 1 << 18, stride: int = 1,
+                 seed: int = 0):
+        super().__init__()
+        assert buffer_size >= batch_size
+        if not paths:
+            raise ValueError("StreamingTextDataset needs at least one file")
+        self.sequence_length = sequence_length
+        self.paths = [Path(path) for path in paths]
+        self.indexer = indexer
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        self.stride = stride
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        # each pass already advances the epoch in whichever copy iterates (the persistent worker's, or
+        # this one without workers); workers that are recreated every epoch need this, as with DistributedSampler
+        self.epoch = epoch
+
+    def _shard(self) -> Tuple[int, int]:
+        info = torch.utils.data.get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            rank, world = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            return rank * workers + worker, world * workers
+        return worker, workers
+
+    def _shard_paths(self, shard: int, shards: int) -> List[Path]:
+        # largest files first, each to the shard with the fewest bytes so far, so that ranks get about the
+        # same amount of text; compressed files count at their compressed size
+        sizes = {path: path.stat().st_size for path in self.paths}
+        loads = [0] * shards
+        assigned: List[List[Path]] = [[] for _ in range(shards)]
+        for path in sorted(self.paths, key=lambda path: (-sizes[path], str(path))):
+            least = loads.index(min(loads))
+            assigned[least].append(path)
+            loads[least] += sizes[path]
+        return assigned[shard]
+
+    def _chunks(self, shard: int, shards: int, rng: np.random.Generator) -> Iterator[np.ndarray]:
+        # encoded text, each chunk prefixed with the previous chunk's last sequence_length - 1 symbols so
+        # every window lands in exactly one chunk
+        paths = self.paths
+        if len(paths) >= shards:
+            paths, shard, shards = self._shard_paths(shard, shards), 0, 1
+        for i in rng.permutation(len(paths)):
+            carry = np.zeros(0, dtype=self.indexer.dtype)
+            with data_util.open_text(paths[i]) as src:
+                for index, text in enumerate(iter(lambda: src.read(self.chunk_size), "")):
+                    # with fewer files than shards every shard decompresses every file but only encodes its
+                    # own chunks; the previous chunk's tail is still needed for the first windows
+                    if index % shards == shard:
+                        tokens = np.concatenate([carry, self.indexer.encode(text)])
+                        yield tokens
+                        carry = tokens[-(self.sequence_length - 1):] if self.sequence_length > 1 else tokens[:0]
+                    elif (index + 1) % shards == shard:
+                        carry = self.indexer.encode(text[-(self.sequence_length - 1):]) \
+                            if self.sequence_length > 1 else carry[:0]
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        shard, shards = self._shard()
+        rng = np.random.default_rng([self.seed, self.epoch, shard])
+        self.epoch += 1
+        buffer = np.empty((self.buffer_size, self.sequence_length), dtype=self.indexer.dtype)
+        filled = 0
+        # evicted windows not yet batched; fewer than batch_size rows between blocks
+        pending = buffer[:0].copy()
+
+        for tokens in self._chunks(shard, shards, rng):
+            if len(tokens) < self.sequence_length:
+                continue
+            # a view into tokens; only a shuffled index is kept per chunk, and windows are copied out of the
+            # view at most buffer_size at a time
+            windows = np.lib.stride_tricks.sliding_window_view(tokens, self.sequence_length)[::self.stride]
+            order = rng.permutation(len(windows))
+            if filled < self.buffer_size:
+                take = min(self.buffer_size - filled, len(order))
+                buffer[filled:filled + take] = windows[order[:take]]
+                filled += take
+                order = order[take:]
+            # each incoming window evicts a random resident one, which is what gets emitted
+            for start in range(0, len(order), self.buffer_size):
+                block = windows[order[start:start + self.buffer_size]]
+                slots = rng.choice(self.buffer_size, size=len(block), replace=False)
+                # one copy per block; the batches are views into it, which is never written again
+                pending = np.concatenate([pending, buffer[slots]])
+                buffer[slots] = block
+                batches = len(pending) // self.batch_size
+                for offset in range(0, batches * self.batch_size, self.batch_size):
+                    yield torch.from_numpy(pending[offset:offset + self.batch_size])
+                pending = pending[batches * self.batch_size:]
+
+        rest = np.concatenate([pending, buffer[rng.permutation(filled)]])
+        for start in range(0, len(rest), self.batch_size):
+            yield torch.from_numpy(rest[start:start + self.batch_size])
@@ -1,3 +1,13 @@
+import itertools
+import multiprocessing
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+import array_bundle
+import data_util
+
+
 def trigram(train_data, unknown_chars):
     count_dict = {} # NOTE: this is a nested dictionary
     for line in train_data:
@@ -68,4 +78,161 @@ def unigram(train_data):
     for ch in unknown_chars:
         del char_count[ch]
 
-    return N, char_count, unknown_chars
\ No newline at end of file
+    return N, char_count, unknown_chars
+
+
+START, STOP, UNK = '<start>', '<stop>', '<unk>'
+START_ID, STOP_ID, UNK_ID = 0, 1, 2
+
+
+class NGramCounts:
+    # counts of every observed n-gram; token ids index vocab and each n-gram is packed into one
+    # int64 key in base len(vocab), so keys are sorted by context first and the final token last
+    def __init__(self, n: int, vocab: List[str], keys: np.ndarray, counts: np.ndarray):
+        self.n = n
+        self.vocab = vocab
+        self.keys = keys
+        self.counts = counts
+
+    def contexts(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # (context keys, index of each context's first n-gram, context totals)
+        context_keys = self.keys // len(self.vocab)
+        starts = np.flatnonzero(np.r_[True, context_keys[1:] != context_keys[:-1]]) if len(self.keys) else \
+            np.zeros(0, dtype=np.int64)
+        sums = np.add.reduceat(self.counts, starts) if len(starts) else np.zeros(0, dtype=np.int64)
+        return context_keys[starts], starts, sums
+
+    def lower(self) -> "NGramCounts":
+        # the (n - 1)-gram counts: every token after the <start> padding ends one n-gram and one
+        # (n - 1)-gram, the n-gram's last n - 1 tokens, so summing over the first token loses nothing
+        keys = self.keys % len(self.vocab) ** (self.n - 1)
+        order = np.argsort(keys, kind="stable")
+        keys, counts = keys[order], self.counts[order]
+        if len(keys):
+            starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+            keys, counts = keys[starts], np.add.reduceat(counts, starts)
+        return NGramCounts(self.n - 1, self.vocab, keys, counts)
+
+    def decode(self, key: int) -> List[str]:
+        tokens = []
+        for _ in range(self.n):
+            key, token = divmod(key, len(self.vocab))
+            tokens.append(self.vocab[token])
+        return tokens[::-1]
+
+    def to_arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        vocab_blob, vocab_offsets = array_bundle.strings_to_arrays(self.vocab)
+        return {prefix + "vocab": vocab_blob, prefix + "vocab_offsets": vocab_offsets,
+                prefix + "keys": self.keys, prefix + "counts": self.counts}
+
+    @classmethod
+    def from_arrays(cls, n: int, arrays: Dict[str, np.ndarray], prefix: str) -> "NGramCounts":
+        vocab = array_bundle.arrays_to_strings(arrays[prefix + "vocab"], arrays[prefix + "vocab_offsets"])
+        return cls(n, vocab, arrays[prefix + "keys"], arrays[prefix + "counts"])
+
+    def to_dicts(self) -> Tuple[Dict[str, int], Dict[str, Dict[str, int]]]:
+        # the sum_map/count_dict pair returned by bigram() and trigram(), contexts joined into one string
+        count_dict = {}
+        for key, count in zip(self.keys.tolist(), self.counts.tolist()):
+            tokens = self.decode(key)
+            ch_map = count_dict.setdefault("".join(tokens[:-1]), {})
+            ch_map[tokens[-1]] = ch_map.get(tokens[-1], 0) + count
+        sum_map = {sequence: sum(ch_map.values()) for sequence, ch_map in count_dict.items()}
+        return sum_map, count_dict
+
+
+_shard_n: int = 3
+_shard_unknown_chars: Set[str] = set()
+
+
+def _init_shard(n: int, unknown_chars: Set[str]):
+    global _shard_n, _shard_unknown_chars
+    _shard_n = n
+    _shard_unknown_chars = unknown_chars
+
+
+def _count_shard(lines: List[str]) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    n = _shard_n
+    codepoints = np.frombuffer("".join(lines).encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+    distinct, inverse = np.unique(codepoints, return_inverse=True)
+    vocab = [START, STOP, UNK]
+    symbol_ids = np.empty(len(distinct), dtype=np.int64)
+    for i, codepoint in enumerate(distinct.tolist()):
+        if chr(codepoint) in _shard_unknown_chars:
+            symbol_ids[i] = UNK_ID
+        else:
+            symbol_ids[i] = len(vocab)
+            vocab.append(chr(codepoint))
+
+    # every line becomes n - 1 <start> tokens, its symbols and one <stop>
+    lengths = np.array([len(line) for line in lines], dtype=np.int64)
+    line_offsets = np.arange(len(lines), dtype=np.int64) * n + (n - 1)
+    sequence = np.full(len(codepoints) + len(lines) * n, START_ID, dtype=np.int64)
+    sequence[np.arange(len(codepoints)) + np.repeat(line_offsets, lengths)] = symbol_ids[inverse.reshape(-1)]
+    sequence[np.cumsum(lengths) + line_offsets] = STOP_ID
+
+    # an n-gram ends on every non-<start> token and never reaches back past its own line's padding
+    ends = np.flatnonzero(sequence != START_ID)
+    keys = np.zeros(len(ends), dtype=np.int64)
+    for m in range(n):
+        keys = keys * len(vocab) + sequence[ends - (n - 1) + m]
+    keys, counts = np.unique(keys, return_counts=True)
+    return vocab, keys, counts.astype(np.int64)
+
+
+def _merge_shards(shards: List[Tuple[List[str], np.ndarray, np.ndarray]], n: int) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    vocab = [START, STOP, UNK]
+    ids = {token: i for i, token in enumerate(vocab)}
+    for shard_vocab, _, _ in shards:
+        for token in shard_vocab:
+            if token not in ids:
+                ids[token] = len(vocab)
+                vocab.append(token)
+    if len(vocab) ** n >= 1 << 63:
+        raise ValueError("{} tokens do not fit {}-gram keys into int64".format(len(vocab), n))
+
+    merged_keys, merged_counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for shard_vocab, keys, counts in shards:
+        remap = np.array([ids[token] for token in shard_vocab], dtype=np.int64)
+        remapped = np.zeros(len(keys), dtype=np.int64)
+        scale = 1
+        for _ in range(n):
+            keys, digit = np.divmod(keys, len(shard_vocab))
+            remapped += remap[digit] * scale
+            scale *= len(vocab)
+        merged_keys.append(remapped)
+        merged_counts.append(counts)
+
+    keys = np.concatenate(merged_keys)
+    counts = np.concatenate(merged_counts)
+    order = np.argsort(keys, kind="stable")
+    keys, counts = keys[order], counts[order]
+    if len(keys):
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        keys, counts = keys[starts], np.add.reduceat(counts, starts)
+    return vocab, keys, counts
+
+
+def ngram(train_data: Iterable[str], unknown_chars: Set[str], n: int, workers: Optional[int] = None,
+          chunk_lines: int = 1 << 16, merge_every: int = 16) -> NGramCounts:
+    workers = workers or multiprocessing.cpu_count()
+    train_data = iter(train_data)
+    chunks = iter(lambda: list(itertools.islice(train_data, chunk_lines)), [])
+    shards = []
+
+    def collect(shard_counts):
+        shards.append(shard_counts)
+        if len(shards) >= merge_every:
+            shards[:] = [_merge_shards(shards, n)]
+
+    if workers == 1:
+        _init_shard(n, unknown_chars)
+        for chunk in chunks:
+            collect(_count_shard(chunk))
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_shard, initargs=(n, unknown_chars)) as pool:
+            for shard_counts in data_util.bounded_imap(pool, _count_shard, chunks, 2 * workers, ordered=False):
+                collect(shard_counts)
+
+    vocab, keys, counts = _merge_shards(shards, n)
+    return NGramCounts(n, vocab, keys, counts)